@@ -0,0 +1,251 @@
+"""Benchmarks for the lookup-table devices built by motor_construction.
+
+Measures class creation, instantiation and connection, _get_table, lookup,
+lookup_by_values, where_am_i and set latency while sweeping the number of rows and axes.
+Every measurement is printed as one JSON object per line so results can be diffed
+between commits.
+
+Two backends are available:
+
+    sim     ophyd.sim fake signals, no network. Measures the Python overhead only and
+            cannot complete real moves, so only set_noop is timed.
+    ioc     A local caproto IOC serving the motor records, Pos-Sel and Val:N-SP PVs,
+            started in a subprocess. Needs caproto and OPHYD_CONTROL_LAYER=caproto
+            (or pyepics) with EPICS_CA_ADDR_LIST pointing at localhost.
+
+Usage:
+
+    python benchmark_motor_construction.py --backend sim --rows 1 5 10 15 --axes 1 2 4 8
+    python benchmark_motor_construction.py --backend ioc --output bench_output.txt
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+import ophyd
+from ophyd import Device, EpicsMotor, Component as Cpt
+from ophyd.sim import make_fake_device
+
+import motor_construction
+from motor_construction import make_device_with_lookup_table, clear_class_cache
+
+
+PREFIX = "BENCH{FS:1"
+MAX_ROWS = 15
+MAX_AXES = 8
+
+
+def axis_suffix(axis_index : int):
+    """Return the motor PV suffix of an axis, following the '-Ax:X}Mtr' convention."""
+    return f"-Ax:X{axis_index}}}Mtr"
+
+
+def row_values(row_number : int, num_axes : int):
+    """Return the preset values stored in a row, distinct for every row and axis."""
+    return [row_number + axis_index / 10 for axis_index in range(num_axes)]
+
+
+def make_base(num_axes : int):
+    """Create a Device class with num_axes EpicsMotor components named x0, x1, ..."""
+    return type(f"BenchAxes{num_axes}", (Device,), {
+        f"x{i}": Cpt(EpicsMotor, axis_suffix(i), name=f"x{i}") for i in range(num_axes)})
+
+
+# IOC backend
+
+def make_ioc_class(num_rows : int = MAX_ROWS, num_axes : int = MAX_AXES):
+    """Create a caproto PVGroup serving num_axes motor records, their Val:N-SP rows and Pos-Sel.
+
+    Closing braces are doubled because caproto expands macros in PV names.
+    """
+    from caproto import ChannelType
+    from caproto.server import PVGroup, pvproperty
+    from caproto.ioc_examples.fake_motor_record import motor_record_simulator
+
+    async def start_motor(group, instance, async_lib):
+        await motor_record_simulator(instance, async_lib, dict(
+            velocity=10., precision=3, acceleration=0.01, resolution=1e-6, user_limits=(-100, 100)))
+
+    body = {}
+    for i in range(num_axes):
+        motor = pvproperty(value=0.0, name=axis_suffix(i).replace("}", "}}"), record="motor", precision=3)
+        body[f"motor{i}"] = motor.startup(start_motor)
+        for row_number in range(1, num_rows + 1):
+            body[f"val{i}_{row_number}"] = pvproperty(
+                value=row_values(row_number, num_axes)[i], precision=3,
+                name=f"-Ax:X{i}}}}}Val:{row_number}-SP")
+
+    names = ["Undefined"] + [f"pos{row_number}" for row_number in range(1, num_rows + 1)]
+    body["pos_sel"] = pvproperty(value=0, name="-Ax:X0}}Pos-Sel", dtype=ChannelType.ENUM,
+                                 enum_strings=names, record="mbbo")
+    return type("BenchIOC", (PVGroup,), body), names
+
+
+def serve(num_rows : int = MAX_ROWS, num_axes : int = MAX_AXES):
+    """Run the benchmark IOC until interrupted."""
+    from caproto.server import run
+
+    ioc_class, names = make_ioc_class(num_rows, num_axes)
+    ioc = ioc_class(prefix=PREFIX.replace("{", "{{"))
+    for row_number in range(1, num_rows + 1):
+        field = ioc.pos_sel.get_field(motor_construction.pos_sel_extensions[row_number])
+        field._data["value"] = names[row_number]
+    run(ioc.pvdb, interfaces=["127.0.0.1"], log_pv_names=False)
+
+
+@contextlib.contextmanager
+def ioc_subprocess(startup_time : float = 3.0):
+    """Start the benchmark IOC in a subprocess for the duration of the block."""
+    proc = subprocess.Popen([sys.executable, __file__, "--serve"],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        time.sleep(startup_time)
+        yield proc
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+# Measurements
+
+def timeit(func, repeat : int, pause : float = 0):
+    """Call func repeat times and return the durations in seconds, sleeping pause seconds after each untimed."""
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start)
+        time.sleep(pause)
+    return durations
+
+
+def summarize(durations : list[float]):
+    """Return min, median, mean and max of durations in seconds."""
+    return dict(n=len(durations), min_s=min(durations), median_s=statistics.median(durations),
+                mean_s=statistics.fmean(durations), max_s=max(durations))
+
+
+def fill_fake_table(device, num_rows : int, num_axes : int):
+    """Put preset names, values and motor limits into a fake device."""
+    for row_number in range(1, num_rows + 1):
+        row = getattr(device.pos_lookup, f"row{row_number}")
+        row.key.sim_put(f"pos{row_number}")
+        for i, value in enumerate(row_values(row_number, num_axes)):
+            getattr(row.values, f"x{i}").sim_put(value)
+    for i in range(num_axes):
+        motor = getattr(device, f"x{i}")
+        motor.user_setpoint.sim_set_limits((-100, 100))
+        motor.user_readback.sim_put(0.0)
+    device.pos_sel.sim_put("Undefined")
+
+
+def bench_configuration(backend : str, num_rows : int, num_axes : int, repeat : int):
+    """Run every measurement for one row and axis count and yield result dictionaries."""
+    base = make_base(num_axes)
+    target_name = f"pos{num_rows}"
+    target_values = tuple(row_values(num_rows, num_axes))
+
+    def make_class():
+        clear_class_cache()
+        return make_device_with_lookup_table(base, lut_suffix="Ax:X0", num_rows=num_rows, precision=3)
+
+    yield "class_creation", timeit(make_class, repeat)
+    yield "class_creation_cached", timeit(
+        lambda: make_device_with_lookup_table(base, lut_suffix="Ax:X0", num_rows=num_rows, precision=3), repeat)
+
+    device_class = make_class()
+    if backend == "sim":
+        device_class = make_fake_device(device_class)
+
+    devices = []
+
+    def instantiate():
+        device = device_class(PREFIX, name=f"bench{len(devices)}")
+        if backend == "sim":
+            fill_fake_table(device, num_rows, num_axes)
+        else:
+            device.wait_for_connection(all_signals=True, timeout=10)
+        devices.append(device)
+
+    yield "instantiate_and_connect", timeit(instantiate, repeat)
+    device = devices[-1]
+    device.refresh()
+
+    yield "_get_table", timeit(device._get_table, repeat)
+    yield "lookup", timeit(lambda: device.lookup(target_name), repeat)
+    yield "lookup_by_values", timeit(lambda: device.lookup_by_values(target_values), repeat)
+    yield "nearest", timeit(lambda: device.nearest(target_values), repeat)
+
+    def where_am_i():
+        with contextlib.redirect_stdout(io.StringIO()):
+            device.where_am_i()
+
+    yield "where_am_i", timeit(where_am_i, repeat)
+
+    if backend == "sim":
+        # Fake motors never finish a move, so only the no-op path is timed
+        for i, value in enumerate(target_values):
+            getattr(device, f"x{i}").user_readback.sim_put(value)
+        device.pos_sel.sim_put(target_name)
+    else:
+        # Alternate between two presets so every call really moves, and let the simulated
+        # motor record finish its cycle before the next move
+        moves = iter([target_name, "pos1"] * repeat)
+        yield "set", timeit(lambda: device.set(next(moves)).wait(timeout=30), repeat, pause=0.5)
+        device.set(target_name).wait(timeout=30)
+        time.sleep(0.5)
+
+    yield "set_noop", timeit(lambda: device.set(target_name).wait(timeout=30), repeat)
+
+    for device in devices:
+        device.destroy()
+
+
+def run_benchmarks(backend : str, rows : list[int], axes : list[int], repeat : int, output=sys.stdout):
+    """Sweep all row and axis counts and write one JSON line per measurement to output."""
+    meta = dict(kind="meta", backend=backend, python=platform.python_version(), ophyd=ophyd.__version__,
+                control_layer=os.environ.get("OPHYD_CONTROL_LAYER", ""), repeat=repeat, time=time.time())
+    print(json.dumps(meta), file=output, flush=True)
+
+    context = ioc_subprocess() if backend == "ioc" else contextlib.nullcontext()
+    with context:
+        for num_axes in axes:
+            for num_rows in rows:
+                for op, durations in bench_configuration(backend, num_rows, num_axes, repeat):
+                    result = dict(kind="result", backend=backend, rows=num_rows, axes=num_axes, op=op)
+                    result.update(summarize(durations))
+                    print(json.dumps(result), file=output, flush=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backend", choices=["sim", "ioc"], default="sim")
+    parser.add_argument("--rows", type=int, nargs="+", default=list(range(1, MAX_ROWS + 1)))
+    parser.add_argument("--axes", type=int, nargs="+", default=list(range(1, MAX_AXES + 1)))
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--output", help="file to append JSON lines to, by default stdout")
+    parser.add_argument("--serve", action="store_true", help="only run the benchmark IOC")
+    args = parser.parse_args(argv)
+
+    if args.serve:
+        serve()
+        return
+    if not all(1 <= n <= MAX_ROWS for n in args.rows) or not all(1 <= n <= MAX_AXES for n in args.axes):
+        parser.error(f"rows must be within 1-{MAX_ROWS} and axes within 1-{MAX_AXES}")
+
+    if args.output:
+        with open(args.output, "a") as output:
+            run_benchmarks(args.backend, args.rows, args.axes, args.repeat, output)
+    else:
+        run_benchmarks(args.backend, args.rows, args.axes, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
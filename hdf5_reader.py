@@ -0,0 +1,411 @@
+"""Direct reader for the HDF5 files written by HDF5PluginWithFileStorePlain.
+
+Instead of filling whole frames through the databroker handlers, HDF5RunReader resolves
+the AD_HDF5 and AD_HDF5_DET_TS resource and datum documents of a run to the file on disk
+and returns lazy views of the image and detector-timestamp datasets. Slicing a view reads
+only the requested frames and pixels, so ROI-only and frame-subset reads touch only the
+HDF5 chunks they need. Uncompressed contiguous datasets are memory-mapped.
+
+    with HDF5RunReader(header.documents(fill=False)) as reader:
+        roi = reader['cam_fs1_hdf5_image'][:, 460:960, 1340:1490]
+        ts = reader['cam_fs1_hdf5_time_stamp'][:]
+
+Files written in SWMR mode (HDF5PluginWithFileStorePlain.set_swmr) can be read while the
+count is running: follow_dataset yields frames as the plugin flushes them, and
+HDF5RunReader(..., swmr=True) opens the files for reading alongside the writer.
+
+read_detector_timestamps reads only the AD_HDF5_DET_TS data of a run, one read per file,
+and frame_timing turns the timestamps into inter-frame interval statistics and dropped
+frames, for checking the camera timing without touching the images.
+"""
+import os
+import time
+from collections import OrderedDict
+
+import event_model
+import h5py
+import numpy as np
+
+
+# Dataset paths in the NeXus layout written by the areaDetector HDF5 plugin, per resource spec
+DATASET_KEYS = {
+    'AD_HDF5': '/entry/data/data',
+    'AD_HDF5_DET_TS': '/entry/instrument/NDAttributes/NDArrayTimeStamp',
+}
+
+
+# Resource kwargs recorded by HDF5PluginWithFileStorePlain.set_layout, not understood by the handlers
+LAYOUT_KWARGS = ('compression', 'compression_level', 'chunks')
+
+
+def layout_tolerant_handler(handler_class):
+    """
+    Return a subclass of a databroker handler that ignores the layout resource kwargs.
+
+    For example, with area_detector_handlers installed:
+
+        db.reg.register_handler('AD_HDF5', layout_tolerant_handler(AreaDetectorHDF5Handler),
+                                overwrite=True)
+    """
+    class LayoutTolerantHandler(handler_class):
+        def __init__(self, *args, **kwargs):
+            for key in LAYOUT_KWARGS:
+                kwargs.pop(key, None)
+            super().__init__(*args, **kwargs)
+
+    LayoutTolerantHandler.__name__ = LayoutTolerantHandler.__qualname__ = f"LayoutTolerant{handler_class.__name__}"
+    return LayoutTolerantHandler
+
+
+def open_dataset(h5file, key):
+    """
+    Open a dataset, memory-mapped when it is stored contiguously and uncompressed.
+
+    Parameters
+    ==========
+    h5file: h5py.File
+        Open HDF5 file
+    key: str
+        Path of the dataset in the file
+
+    Returns
+    =======
+    numpy.memmap or h5py.Dataset
+        Either supports numpy-style slicing and reads only what is selected
+    """
+    dataset = h5file[key]
+    if dataset.chunks is None and dataset.compression is None and dataset.size:
+        offset = dataset.id.get_offset()
+        if offset is not None:
+            return np.memmap(h5file.filename, mode='r', dtype=dataset.dtype,
+                             offset=offset, shape=dataset.shape)
+    return dataset
+
+
+def open_file(path, swmr=False):
+    """Open an HDF5 file for reading, as a SWMR reader if swmr is True."""
+    if swmr:
+        return h5py.File(path, 'r', libver='latest', swmr=True)
+    return h5py.File(path, 'r')
+
+
+def follow_dataset(path, key=DATASET_KEYS['AD_HDF5'], start=0, stop=None, poll_interval=0.2, timeout=10.0):
+    """
+    Yield the frames of a dataset being written in SWMR mode as they are flushed.
+
+    Waits for the writer to open the file. Ends after stop frames, or when no new frames
+    arrived for timeout seconds.
+
+    Parameters
+    ==========
+    path: str
+        HDF5 file
+    key: str
+        Path of the dataset in the file, one of DATASET_KEYS
+    start: int
+        First frame to yield
+    stop: int
+        Number of frames after which to stop, e.g. the number of images of the count
+    poll_interval: float
+        Seconds between checks for new frames
+    timeout: float
+        Seconds to wait for the file and for each new frame
+
+    Yields
+    ======
+    (int, numpy.ndarray)
+        Index of the first frame of the block and the new frames
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            h5file = open_file(path, swmr=True)
+            break
+        except OSError:
+            # Not created yet, or not yet switched to SWMR by the writer
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(poll_interval)
+    with h5file:
+        dataset = h5file[key]
+        while stop is None or start < stop:
+            dataset.refresh()
+            available = dataset.shape[0] if stop is None else min(dataset.shape[0], stop)
+            if available > start:
+                yield start, dataset[start:available]
+                start = available
+                deadline = time.monotonic() + timeout
+            elif time.monotonic() > deadline:
+                return
+            else:
+                time.sleep(poll_interval)
+
+
+class HDF5FrameView:
+    """
+    Lazy, sliceable view of the frames a run stored in one or more HDF5 datasets.
+
+    The first index selects frames in run order, any further indices are passed to the
+    dataset, e.g. view[2:5, 460:960, 1340:1490]. Nothing is read until the view is sliced.
+    """
+    def __init__(self, segments):
+        # List of (dataset, frame indices in the dataset) in run order
+        self._segments = [(dataset, np.asarray(frames, dtype=np.intp)) for dataset, frames in segments]
+        self._offsets = np.cumsum([0] + [len(frames) for _, frames in self._segments])
+        first = self._segments[0][0] if self._segments else None
+        self.dtype = first.dtype if first is not None else np.dtype(float)
+        self.shape = (int(self._offsets[-1]),) + (tuple(first.shape[1:]) if first is not None else ())
+        self.ndim = len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __array__(self, dtype=None, copy=None):
+        arr = self[:]
+        return arr if dtype is None else arr.astype(dtype, copy=False)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if key and key[0] is Ellipsis:
+            frame_key, rest = slice(None), key
+        else:
+            frame_key, rest = (key[0], key[1:]) if key else (slice(None), ())
+        scalar = np.ndim(frame_key) == 0 and not isinstance(frame_key, slice)
+        selected = np.arange(len(self))[frame_key]
+        selected = np.atleast_1d(selected)
+
+        parts = []
+        for i, (dataset, frames) in enumerate(self._segments):
+            start, stop = self._offsets[i], self._offsets[i + 1]
+            mask = (selected >= start) & (selected < stop)
+            if not mask.any():
+                continue
+            parts.append((np.flatnonzero(mask), self._read(dataset, frames[selected[mask] - start], rest)))
+
+        if not parts:
+            out = np.empty((0,) + self.shape[1:], dtype=self.dtype)[(slice(None),) + rest]
+        elif len(parts) == 1:
+            out = parts[0][1]
+        else:
+            first = parts[0][1]
+            out = np.empty((len(selected),) + first.shape[1:], dtype=first.dtype)
+            for positions, values in parts:
+                out[positions] = values
+        return out[0] if scalar else out
+
+    @staticmethod
+    def _read(dataset, frames, rest):
+        """Read the given frame indices of a dataset, as a single slice when they are contiguous."""
+        if len(frames) and np.all(np.diff(frames) == 1):
+            return np.asarray(dataset[(slice(frames[0], frames[-1] + 1),) + rest])
+        # h5py fancy indexing needs increasing, unique indices
+        unique, inverse = np.unique(frames, return_inverse=True)
+        return np.asarray(dataset[(unique,) + rest])[inverse]
+
+
+class HDF5RunReader:
+    """
+    Resolve a run's AD_HDF5 resources and datums to lazy views of the HDF5 files on disk.
+
+    Parameters
+    ==========
+    documents: iterable of (name, doc)
+        Documents of the run with datum ids unfilled, e.g. header.documents(fill=False)
+    stream_name: str
+        Event stream to read, 'primary' by default
+    root_map: dict
+        Optional mapping from resource roots to local paths, as used by databroker
+    swmr: bool
+        Open the files as a SWMR reader, for runs still being written; call refresh()
+        to see the frames flushed since
+    specs: iterable of str
+        Resource specs to resolve, e.g. ('AD_HDF5_DET_TS',); all of DATASET_KEYS by default
+    """
+    def __init__(self, documents, stream_name='primary', root_map=None, swmr=False, specs=None):
+        self.root_map = root_map or {}
+        self.swmr = swmr
+        specs = set(DATASET_KEYS).intersection(DATASET_KEYS if specs is None else specs)
+        # data key -> resource spec and number of frames of each point
+        self.specs = {}
+        self.frames_per_point = {}
+        self._files = {}
+        resources, datums, descriptors = {}, {}, {}
+        # data key -> ordered list of datum ids
+        datum_ids = OrderedDict()
+        for name, doc in documents:
+            if name == 'resource':
+                resources[doc['uid']] = doc
+            elif name == 'datum':
+                datums[doc['datum_id']] = doc
+            elif name == 'datum_page':
+                for datum in event_model.unpack_datum_page(doc):
+                    datums[datum['datum_id']] = datum
+            elif name == 'descriptor' and doc.get('name') == stream_name:
+                descriptors[doc['uid']] = doc
+            elif name in ('event', 'event_page'):
+                events = event_model.unpack_event_page(doc) if name == 'event_page' else [doc]
+                for event in events:
+                    descriptor = descriptors.get(event['descriptor'])
+                    if descriptor is None:
+                        continue
+                    for key, value in event['data'].items():
+                        if 'external' in descriptor['data_keys'][key]:
+                            datum_ids.setdefault(key, []).append(value)
+
+        self._views = OrderedDict()
+        for key, ids in datum_ids.items():
+            segments = []
+            counts = []
+            for datum_id in ids:
+                datum = datums[datum_id]
+                resource = resources[datum['resource']]
+                if resource['spec'] not in specs:
+                    break
+                dataset = self._dataset(resource)
+                fpp = resource['resource_kwargs'].get('frame_per_point', 1)
+                counts.append(fpp)
+                start = datum['datum_kwargs']['point_number'] * fpp
+                frames = np.arange(start, start + fpp)
+                # Merge consecutive datums from the same file into one segment
+                if segments and segments[-1][0] is dataset:
+                    segments[-1][1].append(frames)
+                else:
+                    segments.append((dataset, [frames]))
+            else:
+                self._views[key] = HDF5FrameView(
+                    [(dataset, np.concatenate(frames)) for dataset, frames in segments])
+                self.specs[key] = resource['spec']
+                self.frames_per_point[key] = np.array(counts, dtype=np.intp)
+
+    def _path(self, resource):
+        root = resource.get('root', '')
+        root = self.root_map.get(root, root)
+        return os.path.join(root, resource['resource_path'])
+
+    def _dataset(self, resource):
+        path = self._path(resource)
+        if path not in self._files:
+            self._files[path] = (open_file(path, self.swmr), {})
+        h5file, datasets = self._files[path]
+        key = DATASET_KEYS[resource['spec']]
+        if key not in datasets:
+            # A file still being written must not be memory-mapped
+            datasets[key] = h5file[key] if self.swmr else open_dataset(h5file, key)
+        return datasets[key]
+
+    def refresh(self):
+        """Update the datasets of files opened with swmr=True to the frames flushed so far."""
+        for _, datasets in self._files.values():
+            for dataset in datasets.values():
+                if isinstance(dataset, h5py.Dataset):
+                    dataset.refresh()
+
+    def keys(self):
+        return self._views.keys()
+
+    def __getitem__(self, key):
+        return self._views[key]
+
+    def __contains__(self, key):
+        return key in self._views
+
+    def close(self):
+        """Close every open HDF5 file."""
+        for h5file, _ in self._files.values():
+            h5file.close()
+        self._files.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_detector_timestamps(documents, stream_name='primary', root_map=None):
+    """
+    Read all detector timestamps of a run, without opening the image datasets.
+
+    Consecutive points stored in the same file are read with a single slice, so a run
+    costs one read per file.
+
+    Parameters
+    ==========
+    documents: iterable of (name, doc)
+        Documents of the run with datum ids unfilled, e.g. header.documents(fill=False)
+    stream_name: str
+        Event stream to read, 'primary' by default
+    root_map: dict
+        Optional mapping from resource roots to local paths
+
+    Returns
+    =======
+    dict
+        Data key -> (timestamps of every frame in run order, number of frames of each point)
+    """
+    with HDF5RunReader(documents, stream_name, root_map, specs=('AD_HDF5_DET_TS',)) as reader:
+        return {key: (np.asarray(reader[key][:], dtype=float).ravel(), reader.frames_per_point[key])
+                for key in reader.keys()}
+
+
+def frame_timing(timestamps, frames_per_point=None, expected_period=None, tolerance=0.5):
+    """
+    Inter-frame interval statistics and dropped-frame detection from detector timestamps.
+
+    When points hold several frames, the intervals between the last frame of a point and
+    the first of the next include the trigger overhead; they are reported separately as
+    'point_intervals' and left out of the statistics.
+
+    Parameters
+    ==========
+    timestamps: array-like
+        Detector timestamps in seconds, in acquisition order
+    frames_per_point: array-like of int
+        Number of frames of each point, as returned by read_detector_timestamps
+    expected_period: float
+        Nominal frame period in seconds, the median interval if None
+    tolerance: float
+        An interval longer than (1 + tolerance) periods counts as dropped frames
+
+    Returns
+    =======
+    dict
+        n_frames, period, mean, median, min and max of the intervals in seconds, std and
+        jitter_rms (RMS deviation from the period) of the intervals without gaps; dropped, the estimated number of missing
+        frames; gap_after, the frame indices followed by a gap, with gap_dropped frames
+        missing in each; non_monotonic, the number of repeated or backwards timestamps;
+        point_intervals
+    """
+    ts = np.asarray(timestamps, dtype=float).ravel()
+    dt = np.diff(ts)
+    # Intervals crossing into the next point
+    boundary = np.zeros(len(dt), dtype=bool)
+    if frames_per_point is not None:
+        ends = np.cumsum(frames_per_point)[:-1] - 1
+        boundary[ends[ends < len(dt)]] = True
+    if boundary.all():
+        # One frame per point, the point cadence is the frame cadence
+        boundary[:] = False
+    positions = np.flatnonzero(~boundary)
+    intervals = dt[positions]
+
+    result = dict(n_frames=len(ts), point_intervals=dt[boundary],
+                  non_monotonic=int(np.count_nonzero(dt <= 0)))
+    if not len(intervals):
+        return dict(result, period=expected_period, mean=np.nan, median=np.nan, std=np.nan,
+                    min=np.nan, max=np.nan, jitter_rms=np.nan, dropped=0,
+                    gap_after=np.empty(0, dtype=np.intp), gap_dropped=np.empty(0, dtype=np.intp))
+    median = float(np.median(intervals))
+    period = float(expected_period) if expected_period is not None else median
+    gaps = np.flatnonzero(intervals > (1 + tolerance) * period)
+    gap_dropped = np.maximum(np.rint(intervals[gaps] / period).astype(np.intp) - 1, 1)
+    regular = np.delete(intervals, gaps) if len(gaps) < len(intervals) else intervals
+    return dict(result, period=period, mean=float(intervals.mean()), median=median,
+                std=float(regular.std()), min=float(intervals.min()), max=float(intervals.max()),
+                jitter_rms=float(np.sqrt(np.mean((regular - period) ** 2))),
+                dropped=int(gap_dropped.sum()), gap_after=positions[gaps], gap_dropped=gap_dropped)
@@ -1,14 +1,263 @@
 import ophyd
+import numpy as np
 from ophyd import EpicsMotor, sim, Device, Kind
 from ophyd import Component as Cpt, FormattedComponent as FCpt, DynamicDeviceComponent
-from ophyd.signal import EpicsSignal
+from ophyd.signal import EpicsSignal, InternalSignal
 from ophyd.status import Status
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from functools import partial, reduce
+from pathlib import Path
+import csv
+import itertools
+import json
+import math
+import operator
+import threading
 
 
 # PV extentions for lookup table rows (ommited ZRST row because it is reserved)
 pos_sel_extensions = ["", "ONST", "TWST", "THST", "FRST", "FVST", "SXST", "SVST", "EIST", "NIST" ,"TEST", "ELST", "TVST", "TTST", "FTST", "FFST"] 
 
+# Upper bound on simultaneous PV reads; larger tables (up to 135 PVs for 15 rows with 8 axes) 
+# are read in a few waves
+MAX_CONCURRENT_READS = 32
+_read_executor = None
+_read_executor_lock = threading.Lock()
+
+# Classes built by the factories below, keyed by factory name and structural parameters
+_class_cache = {}
+_class_cache_stats = {"hits": 0, "misses": 0}
+_class_cache_lock = threading.Lock()
+
+
+def _get_cached_class(key : tuple):
+    """Return the class cached under key, or None, and count the hit or miss."""
+    with _class_cache_lock:
+        cls = _class_cache.get(key)
+        _class_cache_stats["hits" if cls is not None else "misses"] += 1
+        return cls
+
+
+def _cache_class(key : tuple, cls):
+    """Cache cls under key and return the cached class. If another thread cached one first, that one wins."""
+    with _class_cache_lock:
+        return _class_cache.setdefault(key, cls)
+
+
+def class_cache_info():
+    """Return the state of the factory class cache.
+
+    Returns
+    -------
+    dict
+        The number of "hits" and "misses", the current "size" and the cached classes under 
+        "entries" as {key: class}, where each key starts with the name of the factory.
+    """
+    with _class_cache_lock:
+        return dict(_class_cache_stats, size=len(_class_cache), entries=dict(_class_cache))
+
+
+def clear_class_cache():
+    """Empty the factory class cache and reset its counters. Existing devices are not affected."""
+    with _class_cache_lock:
+        _class_cache.clear()
+        _class_cache_stats.update(hits=0, misses=0)
+
+
+class _SharedDynamicDeviceComponent(DynamicDeviceComponent):
+    """A DynamicDeviceComponent that creates its Device class only once, so a cached
+    instance can be added to several owner classes and they all share the same class.
+    """
+
+    def __set_name__(self, owner, attr_name):
+        if self.cls is None:
+            super().__set_name__(owner, attr_name)
+        else:
+            Cpt.__set_name__(self, owner, attr_name)
+
+
+def read_signals(signals : list, timeout : float | None = None):
+    """Read many signals at once and wait on all of them together.
+
+    Every read is issued before any of them is waited on, so the total latency is about 
+    one round trip instead of one round trip per signal.
+
+    Parameters
+    ----------
+    signals : list[Signal]
+        The signals to read.
+    timeout : float, optional
+        Seconds to wait for all reads to finish, by default no limit.
+
+    Returns
+    -------
+    list[tuple]
+        A (value, timestamp) tuple for each signal, in the order given.
+
+    Raises
+    ------
+    TimeoutError
+        If the reads did not all finish within timeout.
+    """
+    global _read_executor
+    with _read_executor_lock:
+        if _read_executor is None:
+            _read_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_READS, thread_name_prefix="lookup_read")
+        executor = _read_executor
+
+    futures = [executor.submit(signal.read) for signal in signals]
+    _, not_done = wait(futures, timeout=timeout)
+    if not_done:
+        for future in not_done:
+            future.cancel()
+        raise TimeoutError (f"{len(not_done)} of {len(signals)} reads did not finish within {timeout} s")
+
+    results = []
+    for signal, future in zip(signals, futures):
+        reading = future.result()[signal.name]
+        results.append((reading["value"], reading["timestamp"]))
+    return results
+
+
+def read_lookup_rows(pos_lookup : Device, timeout : float | None = None):
+    """Read the key and values of every row of a pos_lookup component in one batch.
+
+    Parameters
+    ----------
+    pos_lookup : Device
+        An instance of the component created by get_lookup.
+    timeout : float, optional
+        Seconds to wait for all reads to finish, by default no limit.
+
+    Returns
+    -------
+    OrderedDict
+        {row_attr: (key, {col_name: value, ...}, {"key": timestamp, col_name: timestamp, ...})} 
+        in row order.
+    """
+    layout = []
+    signals = []
+    for row_attr in pos_lookup.component_names:
+        row = getattr(pos_lookup, row_attr)
+        col_names = list(row.values.component_names)
+        layout.append((row_attr, col_names))
+        signals.append(row.key)
+        signals.extend(getattr(row.values, col_name) for col_name in col_names)
+
+    readings = iter(read_signals(signals, timeout=timeout))
+    rows = OrderedDict()
+    for row_attr, col_names in layout:
+        key, key_timestamp = next(readings)
+        values, timestamps = {}, {"key": key_timestamp}
+        for col_name in col_names:
+            values[col_name], timestamps[col_name] = next(readings)
+        rows[row_attr] = (key, values, timestamps)
+    return rows
+
+
+def read_lookup_table(pos_lookup : Device, timeout : float | None = None):
+    """Read a whole lookup table in one batch of concurrent reads.
+
+    Parameters
+    ----------
+    pos_lookup : Device
+        An instance of the component created by get_lookup.
+    timeout : float, optional
+        Seconds to wait for all reads to finish, by default no limit.
+
+    Returns
+    -------
+    tuple[dict, dict]
+        The table as {key: {col_name: value, ...}}, the same structure as _get_table, and the 
+        matching timestamps as {key: {"key": timestamp, col_name: timestamp, ...}}.
+    """
+    table = {}
+    timestamps = {}
+    for row_key, values, row_timestamps in read_lookup_rows(pos_lookup, timeout=timeout).values():
+        table[row_key] = values
+        timestamps[row_key] = row_timestamps
+    return table, timestamps
+
+
+def read_table_file(path : str | Path):
+    """Read a lookup table from a CSV or JSON file.
+
+    A CSV file has a "name" column followed by one column per axis, optionally preceded by 
+    a "row" column. A JSON file holds an object of the form {name: {col_name: value, ...}, ...}, 
+    or {row_attr: {"name": name, col_name: value, ...}, ...} as written by export_table.
+
+    Parameters
+    ----------
+    path : str | Path
+        The file to read, the format is chosen by its .csv or .json suffix.
+
+    Returns
+    -------
+    OrderedDict
+        The table as {name: {col_name: value, ...}} in file order, or as 
+        {row_attr: {"name": name, col_name: value, ...}} if the file has a "row" column.
+
+    Raises
+    ------
+    ValueError
+        If the file suffix is not .csv or .json.
+    """
+    path = Path(path)
+    if path.suffix.lower() == ".json":
+        with open(path) as f:
+            return json.load(f, object_pairs_hook=OrderedDict)
+    if path.suffix.lower() == ".csv":
+        table = OrderedDict()
+        with open(path, newline="") as f:
+            for row in csv.DictReader(f):
+                name = row.pop("name")
+                row_attr = row.pop("row", None)
+                values = OrderedDict((col_name, float(value)) for col_name, value in row.items())
+                if row_attr is None:
+                    table[name] = values
+                else:
+                    table[row_attr] = OrderedDict(name=name, **values)
+        return table
+    raise ValueError (f"Unsupported lookup table file {path}, expected a .csv or .json file")
+
+
+def write_table_file(table : dict, path : str | Path):
+    """Write a lookup table to a CSV or JSON file readable by read_table_file.
+
+    Parameters
+    ----------
+    table : dict
+        The table as {name: {col_name: value, ...}}, or as {row_attr: {"name": name, col_name: value, ...}}.
+    path : str | Path
+        The file to write, the format is chosen by its .csv or .json suffix.
+
+    Raises
+    ------
+    ValueError
+        If the file suffix is not .csv or .json.
+    """
+    path = Path(path)
+    if path.suffix.lower() == ".json":
+        with open(path, "w") as f:
+            json.dump(table, f, indent=4)
+    elif path.suffix.lower() == ".csv":
+        by_row = _is_row_table(table)
+        col_names = [col_name for col_name in next(iter(table.values()), {}) if not (by_row and col_name == "name")]
+        with open(path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow((["row"] if by_row else []) + ["name"] + col_names)
+            for name, row in table.items():
+                prefix = [name, row["name"]] if by_row else [name]
+                writer.writerow(prefix + [row[col_name] for col_name in col_names])
+    else:
+        raise ValueError (f"Unsupported lookup table file {path}, expected a .csv or .json file")
+
+
+def _is_row_table(table : dict):
+    """Return True if table is keyed by row attribute, with the preset name stored under "name"."""
+    return bool(table) and all(isinstance(row, dict) and "name" in row for row in table.values())
+
 
 def make_lookup_row(*args, lut_suffix : str, col_suffixes: list[str], col_names : list[str], row_number : int, **kwargs):
     """Create a new Device class representing a row for a lookup table.
@@ -28,8 +277,14 @@ def make_lookup_row(*args, lut_suffix : str, col_suffixes: list[str], col_names
     -------
     LookupRow
         A class representing a single row in the lookup table with dynamic components for each column.
+        The class is cached, repeated calls with the same parameters return the same class.
     """
 
+    cache_key = ("make_lookup_row", lut_suffix, tuple(col_suffixes), tuple(col_names), row_number)
+    cached = _get_cached_class(cache_key)
+    if cached is not None:
+        return cached
+
 
     defn = OrderedDict({
         col_name: (EpicsSignal, "-" + col_suffix.replace("-", "").replace("}Mtr", "") + "}Val:" + str(row_number) + "-SP", {})
@@ -60,17 +315,14 @@ def make_lookup_row(*args, lut_suffix : str, col_suffixes: list[str], col_names
             {key: {col_name: value, ...}} where key is the position selection value and col_name is the name of each column.
             """
 
-            row = {}
-            row_key = self.key.get()
-            row[row_key] = {}
-            for key in defn:
-                row[row_key][key] = getattr(self.values, key).get()
-            return row
+            signals = [self.key] + [getattr(self.values, key) for key in defn]
+            readings = [value for value, _ in read_signals(signals)]
+            return {readings[0]: dict(zip(defn, readings[1:]))}
 
-    return LookupRow
+    return _cache_class(cache_key, LookupRow)
 
 
-def get_lookup(*args, lut_suffix : str, num_rows : int, col_suffixes : list[str], col_names : list[str], **kwargs):
+def get_lookup(*args, lut_suffix : str, num_rows : int, col_suffixes : list[str], col_names : list[str], lazy : bool = False, **kwargs):
 
     """Create a lookup table component for a device with a specific number of rows and columns.
 
@@ -84,22 +336,34 @@ def get_lookup(*args, lut_suffix : str, num_rows : int, col_suffixes : list[str]
         A list of pv suffixes for each column in the lookup table.
     col_names : list[str]
         A list of attribute names for each column in the lookup table.
+    lazy : bool, optional
+        If True, the rows are only instantiated and connected on first access, and the 
+        component is omitted from read() and describe(), by default False.
 
     Returns
     ------- 
     DynamicDeviceComponent
-        A Device that contains num_rows LookupRow components.
+        A Device that contains num_rows LookupRow components. The component is cached, repeated 
+        calls with the same parameters return the same component and Device class.
     """
 
+    cache_key = ("get_lookup", lut_suffix, num_rows, tuple(col_suffixes), tuple(col_names), lazy)
+    cached = _get_cached_class(cache_key)
+    if cached is not None:
+        return cached
+
     defn = OrderedDict({
         (f"row{i}") : (make_lookup_row(col_suffixes=col_suffixes, col_names=col_names, lut_suffix = lut_suffix, row_number=i), "", {"name" : f"row{i}"})
         for i in range(1, num_rows + 1)})
    
-    return DynamicDeviceComponent(defn)
+    pos_lookup = _SharedDynamicDeviceComponent(defn, kind=Kind.omitted if lazy else Kind.normal)
+    pos_lookup.lazy = lazy
+    return _cache_class(cache_key, pos_lookup)
 
 
 def make_epics_motor_with_lookup_table(motor_prefix: str, motor_name: str, 
-        lut_suffix: str, num_rows: int, precision: int = 20, *args, **kwargs):
+        lut_suffix: str, num_rows: int, precision: int = 20, tolerances: dict[str, float] | None = None, 
+        lazy_table: bool = False, *args, **kwargs):
     """Create a new device class that extends an EpicsMotor with a lookup table and position selection.
 
     Parameters
@@ -114,6 +378,12 @@ def make_epics_motor_with_lookup_table(motor_prefix: str, motor_name: str,
         The number of rows in the lookup table.
     precision : int, optional
         The precision for comparing motor values, by default 20.
+    tolerances : dict[str, float], optional
+        Per-axis matching tolerances in engineering units, by default 0.5 * 10**-precision for every axis,
+        half a unit of the last compared decimal, as with rounding to precision.
+    lazy_table : bool, optional
+        If True, the lookup table rows are only instantiated and connected on first table access, 
+        by default False.
     
     Returns
     -------
@@ -121,11 +391,16 @@ def make_epics_motor_with_lookup_table(motor_prefix: str, motor_name: str,
         A new class that adds the lookup table and position selection functionality to an EpicsMotor.
     """
 
-    epics_motor_type = type("EpicsMotorDevice", (Device,), {motor_name: Cpt(EpicsMotor, motor_prefix, name=motor_name, labels=["motor"])})    
-    return make_device_with_lookup_table(epics_motor_type, lut_suffix, num_rows, precision, *args, **kwargs)
+    cache_key = ("make_epics_motor_with_lookup_table", motor_prefix, motor_name)
+    epics_motor_type = _get_cached_class(cache_key)
+    if epics_motor_type is None:
+        epics_motor_type = type("EpicsMotorDevice", (Device,), {motor_name: Cpt(EpicsMotor, motor_prefix, name=motor_name, labels=["motor"])})    
+        epics_motor_type = _cache_class(cache_key, epics_motor_type)
+    return make_device_with_lookup_table(epics_motor_type, lut_suffix, num_rows, precision, tolerances, lazy_table, *args, **kwargs)
 
 
-def make_device_with_lookup_table(base : type[Device], lut_suffix: str, num_rows: int, precision : int = 20, *args, **kwargs):
+def make_device_with_lookup_table(base : type[Device], lut_suffix: str, num_rows: int, precision : int = 20, 
+        tolerances : dict[str, float] | None = None, lazy_table : bool = False, *args, **kwargs):
     """Create a new device class that extends the given cls with a lookup table and position selection.
 
     Parameters
@@ -138,12 +413,37 @@ def make_device_with_lookup_table(base : type[Device], lut_suffix: str, num_rows
         The number of rows in the lookup table.
     precision : int, optional
         The precision for comparing motor values, by default 20.
+    tolerances : dict[str, float], optional
+        Per-axis matching tolerances in engineering units, keyed by motor attribute name. 
+        Axes that are not given default to 0.5 * 10**-precision, the resolution of rounding to precision.
+    lazy_table : bool, optional
+        If True, the pos_lookup rows are only instantiated and connected on first table access 
+        and are left out of read() and describe(). The motors and pos_sel stay eager. 
+        By default False.
     
     Returns
     -------
     DeviceWithLookup
         A new class that adds the lookup table and position selection functionality to cls.
+        The class is cached, repeated calls with the same parameters return the same class.
+
+    Raises
+    ------
+    ValueError
+        If a tolerance is given for an axis that is not a motor of base or is not positive.
     """
+    for axis, tolerance in (tolerances or {}).items():
+        if not (axis in base.__dict__['component_names'] and issubclass(base.__dict__[axis].cls, EpicsMotor)):
+            raise ValueError (f"{axis} is not a motor axis of {base.__name__}")
+        if tolerance <= 0:
+            raise ValueError (f"Tolerance for {axis} must be positive, got {tolerance}")
+
+    cache_key = ("make_device_with_lookup_table", base, lut_suffix, num_rows, precision,
+                 tuple(sorted(tolerances.items())) if tolerances else None, lazy_table)
+    cached = _get_cached_class(cache_key)
+    if cached is not None:
+        return cached
+
     # Gather motor components, column names, and column suffixes from cls
     motor_components = OrderedDict()
     general_components = OrderedDict()
@@ -151,7 +451,7 @@ def make_device_with_lookup_table(base : type[Device], lut_suffix: str, num_rows
     col_suffixes = []
     for key in base.__dict__['component_names']:
         signal = base.__dict__[key]
-        if (base.__dict__[key] == EpicsMotor):
+        if issubclass(signal.cls, EpicsMotor):
             motor_components[key] = base.__dict__[key]
             col_names.append(key)
             col_suffixes.append(signal.suffix)
@@ -159,12 +459,319 @@ def make_device_with_lookup_table(base : type[Device], lut_suffix: str, num_rows
             general_components[key] = base.__dict__[key]
 
     
-    pos_lookup = OrderedDict(pos_lookup = get_lookup(lut_suffix=lut_suffix, num_rows=num_rows, col_suffixes=col_suffixes, col_names = col_names))
+    default_tolerances = OrderedDict((col_name, 0.5 * 10 ** -precision) for col_name in col_names)
+    default_tolerances.update(tolerances or {})
+
+    pos_lookup = OrderedDict(pos_lookup = get_lookup(lut_suffix=lut_suffix, num_rows=num_rows, col_suffixes=col_suffixes, col_names = col_names, lazy = lazy_table))
     pos_sel = OrderedDict(pos_sel = Cpt(EpicsSignal, "-" + lut_suffix + "}Pos-Sel", kind = 'hinted', string=True))
+    # Name of the preset matching the motor readbacks, or "Undefined", derived from monitors without any reads
+    current_preset = OrderedDict(current_preset = Cpt(InternalSignal, value="Undefined", kind = 'normal'))
 
     def __init__(self, *args, **kwargs):
-        super(type(self), self).__init__(*args, **kwargs)
+        super(DeviceWithLookup, self).__init__(*args, **kwargs)
         self.precision = precision
+        self.tolerances = OrderedDict(default_tolerances)
+
+        # In-memory snapshot of the lookup table, kept current by monitors on
+        # the key and values signals of every row: {row_attr: [key, {col_name: value}]}
+        self._table_rows = OrderedDict()
+        # Timestamps of the cached cells: {row_attr: {"key": timestamp, col_name: timestamp}}
+        self._table_timestamps = OrderedDict()
+        self._table_lock = threading.RLock()
+        self._table_stale = True
+        self._value_index = None
+        self._value_matrix = None
+        self._table_subscribed = False
+
+        # Latest motor readbacks from monitors, used to derive current_preset
+        self._readbacks = OrderedDict((axis, None) for axis in col_names)
+        for axis in col_names:
+            getattr(self, axis).user_readback.subscribe(partial(self._on_readback, axis), run=False)
+
+        if not lazy_table:
+            self._subscribe_table()
+
+    def _subscribe_table(self):
+        """
+        Subscribe to the key and values signals of every lookup row so the cached table
+        follows changes made on the IOC. A disconnect marks the cache as stale.
+        In lazy mode this is what instantiates and connects the rows, on first table access.
+        """
+        with self._table_lock:
+            if self._table_subscribed:
+                return
+        # Instantiating the rows connects them in lazy mode, so it happens outside the lock
+        rows = OrderedDict((f"row{i}", getattr(self.pos_lookup, f"row{i}")) for i in range(1, num_rows + 1))
+        with self._table_lock:
+            if self._table_subscribed:
+                return
+            # Every entry exists before the first monitor is live, so a partial table is never complete
+            for row_attr in rows:
+                self._table_rows[row_attr] = [None, OrderedDict((col_name, None) for col_name in col_names)]
+                self._table_timestamps[row_attr] = OrderedDict((cell, None) for cell in ["key"] + col_names)
+            self._table_subscribed = True
+        for row_attr, row in rows.items():
+            signals = [(None, row.key)] + [(col_name, getattr(row.values, col_name)) for col_name in col_names]
+            for col_name, signal in signals:
+                signal.subscribe(partial(self._on_table_update, row_attr, col_name), run=False)
+                signal.subscribe(partial(self._on_table_connection, row_attr, col_name), event_type=signal.SUB_META, run=False)
+
+    def _on_table_update(self, row_attr, col_name, value=None, timestamp=None, **kwargs):
+        """
+        Monitor callback updating a single cell (or the key when col_name is None) of the cached table.
+        The snapshot stops being stale once monitors have delivered every cell.
+        """
+        with self._table_lock:
+            if col_name is None:
+                self._table_rows[row_attr][0] = value
+            else:
+                self._table_rows[row_attr][1][col_name] = value
+            self._table_timestamps[row_attr]["key" if col_name is None else col_name] = timestamp
+            self._value_index = self._value_matrix = None
+            if self._table_stale and self._table_complete():
+                self._table_stale = False
+            self._update_current_preset()
+
+    def _on_table_connection(self, row_attr, col_name, connected=True, **kwargs):
+        """
+        Meta callback marking the cached table as stale when a lookup table PV disconnects.
+        The cell is cleared until the monitor delivers it again on reconnection.
+        """
+        if not connected:
+            with self._table_lock:
+                if col_name is None:
+                    self._table_rows[row_attr][0] = None
+                else:
+                    self._table_rows[row_attr][1][col_name] = None
+                self._table_timestamps[row_attr]["key" if col_name is None else col_name] = None
+                self._table_stale = True
+                self._update_current_preset()
+
+    def _table_complete(self):
+        """
+        Return True if every key and cell of the cached table holds a value.
+        """
+        return all(key is not None and None not in values.values() for key, values in self._table_rows.values())
+
+    def _on_readback(self, axis, value=None, **kwargs):
+        """
+        Monitor callback storing a motor readback and updating current_preset.
+        """
+        with self._table_lock:
+            self._readbacks[axis] = value
+            self._update_current_preset()
+
+    def _update_current_preset(self):
+        """
+        Recompute current_preset from the cached motor readbacks and the cached table. 
+        Never reads from the network, so it is safe to call from monitor callbacks.
+        """
+        with self._table_lock:
+            readbacks = tuple(self._readbacks.values())
+            if self._table_stale or None in readbacks:
+                preset = "Undefined"
+            else:
+                preset = self._match(readbacks, self._get_value_index(refresh=False)) or "Undefined"
+            if preset != self.current_preset.get():
+                self.current_preset.put(preset, internal=True)
+
+    def refresh(self):
+        """
+        Re-read the whole lookup table from the IOC and update the cached snapshot.
+
+        A cell is only overwritten if the value read is newer than the last one delivered by 
+        its monitor, so an update arriving while the table is read is not lost.
+
+        Returns
+        -------
+        dict
+            The refreshed lookup table.
+        """
+        self._subscribe_table()
+        rows = read_lookup_rows(self.pos_lookup)
+        with self._table_lock:
+            for row_attr, (row_key, values, timestamps) in rows.items():
+                cells = [("key", row_key)] + list(values.items())
+                cached_timestamps = self._table_timestamps[row_attr]
+                for cell, value in cells:
+                    cached_timestamp = cached_timestamps[cell]
+                    if cached_timestamp is not None and timestamps[cell] <= cached_timestamp:
+                        continue
+                    if cell == "key":
+                        self._table_rows[row_attr][0] = value
+                    else:
+                        self._table_rows[row_attr][1][cell] = value
+                    cached_timestamps[cell] = timestamps[cell]
+            self._table_stale = not self._table_complete()
+            self._value_index = self._value_matrix = None
+            self._update_current_preset()
+            return self._table_snapshot()
+
+    @property
+    def table_stale(self):
+        """
+        True if the cached lookup table has not been filled yet or a lookup table PV has disconnected.
+        """
+        return self._table_stale
+
+    def _get_cached_table(self):
+        """
+        Return the lookup table from the in-memory snapshot, refreshing it first if it is stale.
+        Same structure as _get_table.
+        """
+        if self._table_stale:
+            return self.refresh()
+        return self._table_snapshot()
+
+    def _table_snapshot(self):
+        """
+        Return the lookup table from the in-memory snapshot as is, without any reads.
+        """
+        with self._table_lock:
+            return {row_key: dict(row) for row_key, row in self._table_rows.values()}
+
+    def _quantize(self, pos):
+        """
+        Return pos as a tuple of grid cells two tolerances wide, one per axis.
+        A value within tolerance of pos falls in the cell of pos or in a neighbouring one.
+        """
+        return tuple(math.floor(value / (2 * tolerance)) for value, tolerance in zip(pos, self.tolerances.values()))
+
+    def _match(self, pos, index):
+        """
+        Return the name of the first row of the table whose values are all within tolerance 
+        of pos, or None. Only the cells of index overlapping pos +/- tolerance are checked.
+        """
+        tolerances = tuple(self.tolerances.values())
+        cells = [{math.floor((value - tolerance) / (2 * tolerance)), math.floor((value + tolerance) / (2 * tolerance))}
+                 for value, tolerance in zip(pos, tolerances)]
+        best = None
+        for cell in itertools.product(*cells):
+            for order, pos_name, values in index.get(cell, ()):
+                if best is not None and best[0] < order:
+                    continue
+                if all(abs(value - table_value) <= tolerance for value, table_value, tolerance in zip(pos, values, tolerances)):
+                    best = (order, pos_name)
+        return best[1] if best is not None else None
+
+    def _get_value_index(self, refresh=True):
+        """
+        Return a dictionary mapping the grid cells of the table positions, see _quantize, 
+        to lists of (row order, position name, values) for _match.
+        The index is rebuilt only after the cached table or the tolerances change.
+        With refresh=False a stale snapshot is used as is instead of being re-read.
+        """
+        if refresh:
+            # Outside the lock: in lazy mode this connects and reads the rows
+            self._get_cached_table()
+        with self._table_lock:
+            if self._value_index is None:
+                index = {}
+                for order, (pos_name, row) in enumerate(self._table_rows.values()):
+                    values = tuple(row.values())
+                    if pos_name is None or None in values:
+                        continue
+                    # _match keeps the first row for duplicate positions, like the linear scan did
+                    index.setdefault(self._quantize(values), []).append((order, pos_name, values))
+                self._value_index = index
+            return self._value_index
+
+    def _get_value_matrix(self):
+        """
+        Return the position names and a (rows, axes) float array of their values.
+        Rows with a missing key or missing values are left out. Rebuilt only after the cached table changes.
+        """
+        # Refresh first, outside the lock: in lazy mode this connects and reads the rows
+        self._get_cached_table()
+        with self._table_lock:
+            if self._value_matrix is None:
+                rows = [(pos_name, list(row.values())) for pos_name, row in self._table_rows.values()
+                        if pos_name is not None and None not in row.values()]
+                values = np.array([row for _, row in rows], dtype=float)
+                self._value_matrix = ([pos_name for pos_name, _ in rows], values.reshape(len(rows), len(col_names)))
+            return self._value_matrix
+
+    def nearest_many(self, positions):
+        """
+        Find the closest preset position for each of many positions in one array operation.
+
+        Distances are measured in units of the per-axis tolerances so axes with different 
+        engineering units are weighted consistently.
+
+        Parameters
+        ----------
+        positions : array_like
+            An (M, axes) array of positions, or a single position of length axes.
+
+        Returns
+        -------
+        list[dict]
+            One dictionary per position with the keys "name" (the closest preset), "residuals" 
+            ({col_name: position - preset}) and "distance".
+
+        Raises
+        ------
+        ValueError
+            If the lookup table has no complete rows.
+        """
+        names, values = self._get_value_matrix()
+        if not names:
+            raise ValueError (f"{self.name} has no complete rows in its lookup table")
+        positions = np.atleast_2d(np.asarray(positions, dtype=float))
+        tolerances = np.array(list(self.tolerances.values()))
+
+        residuals = positions[:, np.newaxis, :] - values[np.newaxis, :, :]
+        distances = np.sqrt(np.sum((residuals / tolerances) ** 2, axis=-1))
+        best = np.argmin(distances, axis=1)
+        rows = np.arange(len(positions))
+
+        return [{"name": names[row_index],
+                 "residuals": dict(zip(col_names, residuals[i, row_index].tolist())),
+                 "distance": float(distances[i, row_index])}
+                for i, row_index in zip(rows, best)]
+
+    def nearest(self, pos : tuple[float] | None = None):
+        """
+        Find the closest preset position and the per-axis residuals.
+
+        Parameters
+        ----------
+        pos : tuple[float], optional
+            The position to compare, by default the current motor readbacks.
+
+        Returns
+        -------
+        dict
+            A dictionary with the keys "name", "residuals" and "distance", see nearest_many.
+        """
+        if pos is None:
+            motors = self._get_motors()
+            pos = tuple(motors[axis]["value"] for axis in motors)
+        return self.nearest_many([pos])[0]
+
+    def set_tolerances(self, **tolerances):
+        """
+        Set the matching tolerance of one or more axes in engineering units.
+
+        Parameters
+        ----------
+        **tolerances : float
+            Tolerances keyed by motor attribute name, e.g. x=0.01.
+
+        Raises
+        ------
+        ValueError
+            If an axis is not part of the lookup table or a tolerance is not positive.
+        """
+        for axis, tolerance in tolerances.items():
+            if axis not in self.tolerances:
+                raise ValueError (f"{axis} is not an axis of {self.name}")
+            if tolerance <= 0:
+                raise ValueError (f"Tolerance for {axis} must be positive, got {tolerance}")
+        with self._table_lock:
+            self.tolerances.update(tolerances)
+            self._value_index = self._value_matrix = None
+            self._update_current_preset()
 
 
     def _get_motors(self):
@@ -184,19 +791,117 @@ def make_device_with_lookup_table(base : type[Device], lut_suffix: str, num_rows
         Return a dictionary representing the lookup table where keys are the row names, 
         and values are dictionaries of column names and their values.
         """
-        table = {}
-        for i in range(1, num_rows + 1):
-            key = f"row{i}"
-            row = getattr(self.pos_lookup, key).get_row()
-            row_key = next(iter(row))
-            table[row_key] = row[row_key]
-        return table
+        return self.read_table()[0]
+
+    def read_table(self, timeout : float | None = None):
+        """
+        Read the whole lookup table from the IOC with one batch of concurrent reads.
+
+        Parameters
+        ----------
+        timeout : float, optional
+            Seconds to wait for all reads to finish, by default no limit.
+
+        Returns
+        -------
+        tuple[dict, dict]
+            The table and its timestamps, see read_lookup_table.
+        """
+        self._subscribe_table()
+        return read_lookup_table(self.pos_lookup, timeout=timeout)
     
+    def load_table(self, table : dict | str | Path, timeout : float | None = None) -> Status:
+        """
+        Write a whole lookup table, only putting the key and values PVs that differ from the 
+        current table. All puts are started at once.
+
+        A table exported by export_table is written back row by row, so rows sharing a name 
+        (e.g. unused "" rows) keep their place. A table keyed by name is filled in order from 
+        row1. Rows not in the given table are left untouched.
+
+        Parameters
+        ----------
+        table : dict | str | Path
+            The table as {row_attr: {"name": name, col_name: value, ...}} or {name: {col_name: value, ...}}, 
+            or a CSV or JSON file, see read_table_file.
+        timeout : float, optional
+            Seconds to wait for each put to be read back, by default no limit.
+
+        Returns
+        -------
+        Status
+            A single Status that finishes once every changed PV reads back its new value.
+
+        Raises
+        ------
+        ValueError
+            If the table has too many or unknown rows or its columns do not match the axes.
+        """
+        if not isinstance(table, dict):
+            table = read_table_file(table)
+        if _is_row_table(table):
+            rows = OrderedDict((row_attr, (row["name"], {col_name: value for col_name, value in row.items() if col_name != "name"}))
+                               for row_attr, row in table.items())
+            for row_attr in rows:
+                if row_attr not in self.pos_lookup.component_names:
+                    raise ValueError (f"{row_attr} is not a row of {self.name}")
+        else:
+            if len(table) > num_rows:
+                raise ValueError (f"Table has {len(table)} rows but {self.name} only has {num_rows}")
+            rows = OrderedDict((f"row{i}", (name, row)) for i, (name, row) in enumerate(table.items(), start=1))
+        for row_attr, (name, row) in rows.items():
+            if sorted(row) != sorted(col_names):
+                raise ValueError (f"Row {name} has columns {list(row)}, expected {col_names}")
+
+        # Make sure the snapshot is current before diffing against it
+        self._get_cached_table()
+        with self._table_lock:
+            current = {row_attr: (key, dict(values)) for row_attr, (key, values) in self._table_rows.items()}
+
+        statuses = []
+        for row_attr, (name, row) in rows.items():
+            lookup_row = getattr(self.pos_lookup, row_attr)
+            current_key, current_values = current[row_attr]
+            if current_key != name:
+                statuses.append(lookup_row.key.set(name, timeout=timeout))
+            for col_name in col_names:
+                if current_values[col_name] != row[col_name]:
+                    statuses.append(getattr(lookup_row.values, col_name).set(row[col_name], timeout=timeout))
+
+        if not statuses:
+            status = Status(self)
+            status.set_finished()
+            return status
+        return reduce(operator.and_, statuses)
+
+    def export_table(self, path : str | Path | None = None):
+        """
+        Return the current lookup table, one record per row, and optionally save it to a file.
+
+        Parameters
+        ----------
+        path : str | Path, optional
+            A .csv or .json file to write the table to, see write_table_file.
+
+        Returns
+        -------
+        OrderedDict
+            The lookup table as {row_attr: {"name": name, col_name: value, ...}} in row order, 
+            which load_table writes back to the same rows.
+        """
+        self._get_cached_table()
+        with self._table_lock:
+            table = OrderedDict((row_attr, OrderedDict(name=key, **values))
+                                for row_attr, (key, values) in self._table_rows.items())
+        if path is not None:
+            write_table_file(table, path)
+        return table
+
     def get_all_positions(self):
         """
         Print all possible positions from the lookup table.
         """
-        lookup = self._get_table()
+        lookup = self._get_cached_table()
         length = len(lookup)
         print(f"\n  {length} Possible Positions:")
         print("----------------------------------")
@@ -223,7 +928,7 @@ def make_device_with_lookup_table(base : type[Device], lut_suffix: str, num_rows
         ValueError
             If the name is not found in the lookup table.
         """
-        lookup = self._get_table()
+        lookup = self._get_cached_table()
 
         new_name = (name)
 
@@ -239,7 +944,8 @@ def make_device_with_lookup_table(base : type[Device], lut_suffix: str, num_rows
         Parameters
         ----------
         pos : tuple[float]
-            A tuple of position values to look up.
+            A tuple of position values to look up. Each value matches a table value when they 
+            differ by at most that axis' tolerance.
 
         Returns
         -------
@@ -251,18 +957,7 @@ def make_device_with_lookup_table(base : type[Device], lut_suffix: str, num_rows
         ValueError
             If no matching position is found in the lookup table.
         """
-        lookup = self._get_table()
-        matched_entry = None
-        for lookup_index in range(len(lookup)):
-            
-            lookup_entry_key = list(lookup.keys())[lookup_index]
-            lookup_entry_values = list(lookup[lookup_entry_key].values())
-            match = all(round(pos[axis_index], self.precision) == round(lookup_entry_values[axis_index], self.precision) for axis_index in range(len(pos)))
-            
-                    
-            if match == True:
-                matched_entry = lookup_entry_key
-                break
+        matched_entry = self._match(tuple(pos), self._get_value_index())
 
         if matched_entry == None:
             raise ValueError (f"Could not find {pos} in lookup")
@@ -292,6 +987,11 @@ def make_device_with_lookup_table(base : type[Device], lut_suffix: str, num_rows
         
         if (matched_entry is None) or (pos_sel_val != matched_entry):
             print("\nYour motor values and/or Pos-Sel do not match one of the preset positions")
+            try:
+                nearest = self.nearest(motor_values)
+                print("Nearest preset position is " + nearest["name"] + ", off by ", nearest["residuals"])
+            except ValueError:
+                pass
             print("Use " + self.name + ".get_all_positions() to see all preset positions.")
         else:
             print("\nYour motor and pos-sel values matched the position: " + matched_entry + " = ", self.lookup(matched_entry))
@@ -324,15 +1024,74 @@ def make_device_with_lookup_table(base : type[Device], lut_suffix: str, num_rows
         status : optional
             The status of the move operation, if applicable.
         """
-        self.set_pos_sel("Undefined")
         motors = self._get_motors()
         motor_values = tuple([motors[axis]["setpoint"] for axis in motors])
-        self.set_pos_sel(motor_values)
+        try:
+            pos = self.lookup_by_values(motor_values)
+        except ValueError:
+            pos = "Undefined"
+        if self.pos_sel.get() != pos:
+            self.set_pos_sel(pos)
+
+    def _get_target(self, target : str | tuple):
+        """
+        Return the target position as a tuple of values and its preset name, or None if it is not a preset.
+        """
+        if isinstance(target, str):
+            return tuple(self.lookup(target).values()), target
+        try:
+            return tuple(target), self.lookup_by_values(tuple(target))
+        except ValueError:
+            return tuple(target), None
+
+    def estimate_move_time(self, target : str | tuple) -> float:
+        """
+        Estimate how long a move to target takes from each motor's velocity and acceleration.
+
+        Each axis follows a trapezoidal velocity profile, where the acceleration is the time 
+        to reach full velocity. Axes move at the same time, so the estimate is the slowest axis.
+
+        Parameters
+        ----------
+        target : str | tuple
+            The position to move to, either as a name (str) or as a tuple of values (tuple).
+
+        Returns
+        -------
+        float
+            The estimated move time in seconds, 0 if no axis has to move.
+
+        Raises
+        ------
+        ValueError
+            If an axis that has to move has no positive velocity set.
+        """
+        values, _ = self._get_target(target)
+        motors = self._get_motors()
+        move_time = 0.0
+        for axis, value in zip(motors, values):
+            distance = abs(value - motors[axis]["value"])
+            if distance <= self.tolerances[axis]:
+                continue
+            motor = getattr(self, axis)
+            velocity = motor.velocity.get()
+            accel_time = motor.acceleration.get()
+            if not velocity or velocity <= 0:
+                raise ValueError (f"Cannot estimate the move time of {motor.name}, its velocity is {velocity}")
+            if distance >= velocity * accel_time:
+                axis_time = distance / velocity + accel_time
+            else:
+                # Never reaches full velocity, triangular profile
+                axis_time = 2 * (distance * accel_time / velocity) ** 0.5
+            move_time = max(move_time, axis_time)
+        return move_time
 
     def set(self, size : str | tuple) -> Status:
         """
         Set the motors to a specific position or by its position name and sync it with the pos_sel signal.
 
+        Axes already within tolerance of the target are not commanded. If no axis has to move 
+        and the target preset is already selected, nothing is written at all.
 
         Parameters
         ----------
@@ -345,21 +1104,24 @@ def make_device_with_lookup_table(base : type[Device], lut_suffix: str, num_rows
             A Status object indicating the status of the move operation.
         """
 
-        if isinstance(size, str):
-            values = list(self.lookup(size).values())
-        else: values = list(size)
-        
+        values, target_name = self._get_target(size)
 
         motors = self._get_motors()
-        axes = list(motors.keys())
-
-        self.set_pos_sel("Undefined")
-        init_motor = getattr(self, axes[0])
-        move_status = init_motor.set(values[0])
-
-        for axis_index in range(1, len(axes)):
-            curr_motor = getattr(self, axes[axis_index])
-            move_status = move_status & curr_motor.set(values[axis_index])
+        axes = [axis for axis, value in zip(motors, values)
+                if abs(value - motors[axis]["value"]) > self.tolerances[axis]]
+
+        if not axes:
+            target_name = target_name or "Undefined"
+            if self.pos_sel.get() == target_name:
+                status = Status(self)
+                status.set_finished()
+                return status
+            return self.set_pos_sel(target_name)
+
+        # put, not set, so the Pos-Sel write in _sync_pos_sel cannot collide with a pending set
+        self.pos_sel.put("Undefined")
+        target = dict(zip(motors, values))
+        move_status = reduce(operator.and_, [getattr(self, axis).set(target[axis]) for axis in axes])
 
         move_status.add_callback(self._sync_pos_sel)
         return move_status
@@ -372,26 +1134,101 @@ def make_device_with_lookup_table(base : type[Device], lut_suffix: str, num_rows
             # Add new methods
             __init__ = __init__,
             _get_motors = _get_motors,
+            _subscribe_table = _subscribe_table,
+            _on_table_update = _on_table_update,
+            _on_table_connection = _on_table_connection,
+            _table_complete = _table_complete,
+            _on_readback = _on_readback,
+            _update_current_preset = _update_current_preset,
+            refresh = refresh,
+            table_stale = table_stale,
             _get_table = _get_table,
+            read_table = read_table,
+            _get_cached_table = _get_cached_table,
+            _table_snapshot = _table_snapshot,
+            _quantize = _quantize,
+            _match = _match,
+            _get_value_index = _get_value_index,
+            _get_value_matrix = _get_value_matrix,
+            nearest_many = nearest_many,
+            nearest = nearest,
+            set_tolerances = set_tolerances,
+            load_table = load_table,
+            export_table = export_table,
             get_all_positions = get_all_positions,
             lookup = lookup,
             lookup_by_values = lookup_by_values,
             where_am_i = where_am_i,
             set_pos_sel = set_pos_sel,
             _sync_pos_sel = _sync_pos_sel,
+            _get_target = _get_target,
+            estimate_move_time = estimate_move_time,
             set = set
         )
 
     # Add new components
-    clsdict = clsdict | motor_components | pos_sel | pos_lookup | general_components
+    clsdict = clsdict | motor_components | pos_sel | current_preset | pos_lookup | general_components
     
     # Create the new class with the new  components and methods
     DeviceWithLookup = type("DeviceWithLookup", (base,), clsdict, **{})
 
-    return DeviceWithLookup
-
+    return _cache_class(cache_key, DeviceWithLookup)
 
 
+def find_nearest_presets(devices : list[Device], positions : list | None = None):
+    """Find the closest preset position of many lookup devices at once.
 
+    Devices with the same number of axes are stacked into one padded array so each group 
+    is resolved with a single batched array operation.
 
+    Parameters
+    ----------
+    devices : list[DeviceWithLookup]
+        The devices to check.
+    positions : list, optional
+        One position per device, by default the current motor readbacks of each device.
 
+    Returns
+    -------
+    dict
+        A dictionary mapping each device name to the result of its nearest() query, 
+        or None if its lookup table has no complete rows.
+    """
+    if positions is None:
+        positions = []
+        for device in devices:
+            motors = device._get_motors()
+            positions.append(tuple(motors[axis]["value"] for axis in motors))
+
+    groups = OrderedDict()
+    for device, pos in zip(devices, positions):
+        groups.setdefault(len(device.tolerances), []).append((device, pos))
+
+    results = {}
+    for num_axes, members in groups.items():
+        matrices = [device._get_value_matrix() for device, _ in members]
+        max_rows = max(len(names) for names, _ in matrices)
+        if max_rows == 0:
+            results.update({device.name: None for device, _ in members})
+            continue
+
+        # Pad tables to the same row count, padded rows never win
+        table = np.full((len(members), max_rows, num_axes), np.nan)
+        for i, (names, values) in enumerate(matrices):
+            table[i, :len(names)] = values
+        pos = np.array([pos for _, pos in members], dtype=float).reshape(len(members), 1, num_axes)
+        tolerances = np.array([list(device.tolerances.values()) for device, _ in members]).reshape(len(members), 1, num_axes)
+
+        residuals = pos - table
+        distances = np.sqrt(np.sum((residuals / tolerances) ** 2, axis=-1))
+        distances[np.isnan(distances)] = np.inf
+        best = np.argmin(distances, axis=1)
+
+        for i, ((device, _), (names, _)) in enumerate(zip(members, matrices)):
+            if not names:
+                results[device.name] = None
+                continue
+            results[device.name] = {"name": names[best[i]],
+                                    "residuals": dict(zip(device.tolerances, residuals[i, best[i]].tolist())),
+                                    "distance": float(distances[i, best[i]])}
+    return results
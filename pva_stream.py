@@ -0,0 +1,132 @@
+"""Live frame stream from an areaDetector PVA plugin.
+
+LiveFrameStream monitors the NTNDArray served by a camera's NDPluginPva and keeps the
+most recent frames in a bounded ring. Frames are numpy views of the buffers decoded by
+p4p, reshaped without copying. An optional analyze function runs on every frame, e.g.
+ROI sums and centroids during alignment, and on_update is called with each new entry.
+
+    stream = LiveFrameStream('XF:23IDA-BI:1{FS:1-Cam:1}Pva1:Image', maxlen=8)
+    stream.start()
+    stream.latest['image']
+    stream.stop()
+
+Needs p4p, which is only imported when a stream is started.
+"""
+import threading
+from collections import deque
+
+import numpy as np
+
+
+def decode_ntndarray(value):
+    """
+    Return the image of an NTNDArray as a numpy array of shape (rows, columns[, colors]).
+
+    Parameters
+    ==========
+    value: p4p.Value
+        NTNDArray structure as received from a monitor with nt=False
+
+    Returns
+    =======
+    numpy.ndarray
+        View of the decoded buffer; NDArray dimensions are fastest-first, so they are reversed
+    """
+    data = value['value']
+    sizes = [dim['size'] for dim in value['dimension']]
+    return np.asarray(data).reshape(sizes[::-1])
+
+
+class LiveFrameStream:
+    """
+    Bounded ring of the most recent frames of a PVA NTNDArray stream.
+
+    Parameters
+    ==========
+    pv_name: str
+        NTNDArray PV, the PvName_RBV of the PVA plugin
+    maxlen: int
+        Number of frames kept
+    analyze: callable
+        Optional function of the image whose result is stored with each frame under 'stats'
+    on_update: callable
+        Optional function called with each new entry, from the p4p worker thread
+    provider: str
+        p4p provider name, 'pva' by default
+    """
+    def __init__(self, pv_name, maxlen=16, analyze=None, on_update=None, provider='pva'):
+        self.pv_name = pv_name
+        self.analyze = analyze
+        self.on_update = on_update
+        self.provider = provider
+        self.frames = deque(maxlen=maxlen)
+        self.received = 0
+        self.dropped = 0
+        self._last_uid = None
+        self._lock = threading.Lock()
+        self._context = None
+        self._subscription = None
+        self._new_frame = threading.Condition(self._lock)
+
+    @property
+    def running(self):
+        return self._subscription is not None
+
+    @property
+    def latest(self):
+        """The most recent entry, a dict with 'uid', 'timestamp', 'image' and 'stats', or None."""
+        with self._lock:
+            return self.frames[-1] if self.frames else None
+
+    def start(self):
+        """Start monitoring the PV."""
+        if self.running:
+            return self
+        from p4p.client.thread import Context
+
+        self._context = Context(self.provider, nt=False)
+        self._subscription = self._context.monitor(self.pv_name, self._on_value, notify_disconnect=True)
+        return self
+
+    def stop(self):
+        """Stop monitoring and release the client context. The collected frames are kept."""
+        if self._subscription is not None:
+            self._subscription.close()
+            self._subscription = None
+        if self._context is not None:
+            self._context.close()
+            self._context = None
+
+    def wait_for_frame(self, timeout=None):
+        """Block until a frame newer than the current latest arrives and return its entry."""
+        with self._new_frame:
+            received = self.received
+            if not self._new_frame.wait_for(lambda: self.received > received, timeout=timeout):
+                raise TimeoutError(f"No frame from {self.pv_name} within {timeout} s")
+            return self.frames[-1]
+
+    def _on_value(self, value):
+        # Disconnections and errors arrive as exceptions
+        if isinstance(value, Exception):
+            return
+        image = decode_ntndarray(value)
+        uid = value['uniqueId']
+        ts = value['timeStamp']
+        entry = dict(uid=uid, timestamp=ts['secondsPastEpoch'] + ts['nanoseconds'] * 1e-9, image=image,
+                     stats=self.analyze(image) if self.analyze is not None else None)
+        with self._new_frame:
+            # Frames skipped by the IOC or the monitor queue show up as gaps in uniqueId
+            if self._last_uid is not None and uid > self._last_uid + 1:
+                self.dropped += uid - self._last_uid - 1
+            self._last_uid = uid
+            self.frames.append(entry)
+            self.received += 1
+            self._new_frame.notify_all()
+        if self.on_update is not None:
+            self.on_update(entry)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
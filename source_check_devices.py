@@ -5,7 +5,7 @@ from bluesky.plan_stubs import mvr, mv
 from bluesky.plans import count
 import logging
 from typing import Union, Optional
-from functools import reduce
+from functools import reduce, partial
 import networkx as nx
 from ophyd import (EpicsScaler, EpicsSignal, EpicsMotor, EpicsSignalRO, Device, BlueskyInterface,
                    SingleTrigger, HDF5Plugin, ImagePlugin, StatsPlugin,
@@ -14,29 +14,42 @@ from ophyd.areadetector.cam import AreaDetectorCam, ADBase
 from ophyd.areadetector.detectors import DetectorBase
 from ophyd.areadetector.filestore_mixins import FileStoreHDF5IterativeWrite, FileStoreTIFFIterativeWrite, resource_factory
 from ophyd.areadetector import ADComponent, EpicsSignalWithRBV
-from ophyd.areadetector.plugins import PluginBase, ProcessPlugin, HDF5Plugin_V22, TIFFPlugin_V22, CircularBuffPlugin_V34, CircularBuffPlugin, PvaPlugin
-from ophyd import Component as Cpt, DeviceStatus
+from ophyd.areadetector.plugins import PluginBase, ProcessPlugin, HDF5Plugin_V22, TIFFPlugin_V22, CircularBuffPlugin_V34, CircularBuffPlugin, PvaPlugin, PvaPlugin_V25
+from ophyd import Component as Cpt, DeviceStatus, Kind
 from ophyd.device import FormattedComponent as FCpt
-from ophyd.status import Status, SubscriptionStatus
+from ophyd.status import Status, SubscriptionStatus, StatusTimeoutError
 from ophyd.pv_positioner import PVPositioner, PVPositionerPC
 from pathlib import PurePath
 import time as ttime
 import itertools
+import threading
+from collections import deque, OrderedDict
+import event_model
 from ophyd.sim import NullStatus
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.patches as patches
 import datetime
 from motor_construction import make_device_with_lookup_table
+from pva_stream import LiveFrameStream
+from hdf5_reader import DATASET_KEYS, follow_dataset, read_detector_timestamps, frame_timing
 _time_fmtstr = '%Y-%m-%d %H:%M:%S'
 
 
 # Fluo Screen 1 Camera Classes
+# numpy dtype strings of the areaDetector NDDataType values
+AD_DTYPE_STR = {'Int8': '|i1', 'UInt8': '|u1', 'Int16': '<i2', 'UInt16': '<u2',
+                'Int32': '<i4', 'UInt32': '<u4', 'Int64': '<i8', 'UInt64': '<u8',
+                'Float32': '<f4', 'Float64': '<f8'}
+
 def update_describe_typing(dic, obj):
     """
     Function for updating dictionary result of `describe` to include better typing.
     Previous defaults did not use `dtype_str` and simply described an image as an array.
 
+    Uses the camera data type cached by the plugin when available, so describe() does
+    not need a CA round trip.
+
     Parameters
     ==========
     dic: dict
@@ -45,10 +58,11 @@ def update_describe_typing(dic, obj):
         Instance of plugin
     """
     key = obj.parent._image_name
-    cam_dtype = obj.parent.cam.data_type.get(as_string=True)
-    type_map = {'UInt8': '|u1', 'UInt16': '<u2', 'Float32':'<f4', "Float64":'<f8'}
-    if cam_dtype in type_map:
-        dic[key].setdefault('dtype_str', type_map[cam_dtype])
+    cam_dtype = getattr(obj, '_cam_dtype', None)
+    if cam_dtype is None:
+        cam_dtype = obj.parent.cam.data_type.get(as_string=True)
+    if cam_dtype in AD_DTYPE_STR:
+        dic[key].setdefault('dtype_str', AD_DTYPE_STR[cam_dtype])
 
 class ExternalFileReference(Signal):
     """
@@ -69,11 +83,43 @@ class ExternalFileReference(Signal):
         )
         return res
 
-class HDF5PluginWithFileStorePlain(HDF5Plugin_V22, FileStoreHDF5IterativeWrite): ##SOURCED FROM BELOW FROM FCCD WITH SWMR removed
+# Compression Enum strings of the HDF5 plugin; lz4, bslz4 and blosc need ADCore 3.2 or later
+HDF5_COMPRESSION = {'none': 'None', 'zlib': 'zlib', 'lz4': 'lz4', 'bslz4': 'bslz4', 'blosc': 'blosc'}
+
+def crop_aligned_chunk(start, stop, min_size=64, max_size=512):
+    """
+    Chunk length along one axis that reads the fewest pixels when reading [start, stop).
+
+    Parameters
+    ==========
+    start, stop: int
+        Crop window along the axis, e.g. V1, V2 of FLUO_CROP
+    min_size, max_size: int
+        Range of chunk lengths considered; ties go to the largest length, for fewer chunks
+
+    Returns
+    =======
+    int
+    """
+    def pixels_read(size):
+        return (-(-stop // size) - start // size) * size
+    return min(range(min_size, max_size + 1), key=lambda size: (pixels_read(size), -size))
+
+class HDF5PluginWithFileStorePlain(HDF5Plugin_V22, FileStoreHDF5IterativeWrite): ##SOURCED FROM BELOW FROM FCCD, SWMR is opt-in via set_swmr
     _default_read_attrs = ("time_stamp",)
     # Captures the datum id for the timestamp recorded in the HDF5 file
     time_stamp = Cpt(ExternalFileReference, value="", kind="normal", shape=[])
 
+    # Blosc settings, ADCore 3.2 or later; only used when blosc compression is selected
+    blosc_compressor = Cpt(EpicsSignalWithRBV, 'BloscCompressor', string=True, kind='omitted')
+    blosc_level = Cpt(EpicsSignalWithRBV, 'BloscLevel', kind='omitted')
+    blosc_shuffle = Cpt(EpicsSignalWithRBV, 'BloscShuffle', string=True, kind='omitted')
+
+    # SWMR settings, ADCore 2.5 or later; only used in SWMR mode
+    swmr_supported = Cpt(EpicsSignalRO, 'SWMRSupported_RBV', string=True, kind='omitted')
+    swmr_mode = Cpt(EpicsSignalWithRBV, 'SWMRMode', string=True, kind='omitted')
+    swmr_active = Cpt(EpicsSignalRO, 'SWMRActive_RBV', string=True, kind='omitted')
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         # In CSS help: "N < 0: Up to abs(N) new directory levels will be created"
@@ -86,11 +132,167 @@ class HDF5PluginWithFileStorePlain(HDF5Plugin_V22, FileStoreHDF5IterativeWrite):
         self._ts_resource_uid = ""
         self._ts_counter = None
 
+        # Timestamp datums not yet collected
+        self._ts_pending = []
+
+        # Camera data type for describe(), kept until cam.data_type changes
+        self._cam_dtype = None
+        self._cam_dtype_sub = None
+
+        # Compression and chunking, see set_layout; None keeps the IOC settings
+        self.layout = None
+
+        # Frames between SWMR flushes, see set_swmr; None writes without SWMR
+        self.swmr_flush_frames = None
+
+    def set_layout(self, compression='zlib', level=None, chunks=None, crop=None,
+                   blosc_compressor='LZ4', blosc_shuffle='Bit'):
+        """
+        Set the compression and chunk shape staged for the next acquisitions.
+
+        The layout is recorded in the AD_HDF5 resource kwargs under 'compression',
+        'compression_level' and 'chunks'. Readers going through databroker need a handler
+        that accepts them, see hdf5_reader.layout_tolerant_handler.
+
+        Parameters
+        ==========
+        compression: str or None
+            Key of HDF5_COMPRESSION, or None to stop staging any layout
+        level: int
+            zlib level (1-9) or Blosc level (0-9), the IOC setting if None
+        chunks: tuple of int
+            (frames, rows, columns) per chunk, all positive and checked against the frame
+            size of the camera when staging
+        crop: tuple of int
+            Crop window (V1, V2, H1, H2) to align single-frame chunks with instead of
+            chunks, sized by crop_aligned_chunk along each axis and no larger than the
+            frame; e.g. (1, 64, 166) for FLUO_CROP
+        blosc_compressor, blosc_shuffle: str
+            Blosc codec and shuffle mode, only used with blosc compression
+        """
+        if compression is None:
+            self.layout = None
+            return
+        if compression not in HDF5_COMPRESSION:
+            raise ValueError(f"Unknown compression {compression!r}, expected one of {list(HDF5_COMPRESSION)}")
+        if crop is not None:
+            V1, V2, H1, H2 = crop
+            if not (0 <= V1 < V2 and 0 <= H1 < H2):
+                raise ValueError(f"Invalid crop {crop}, expected 0 <= V1 < V2 and 0 <= H1 < H2")
+            # The frame size is 0 until the camera reports it
+            frame_height = self.parent.cam.array_size.array_size_y.get() or V2
+            frame_width = self.parent.cam.array_size.array_size_x.get() or H2
+            rows = min(V2 - V1, frame_height)
+            cols = min(H2 - H1, frame_width)
+            chunks = (1, crop_aligned_chunk(V1, V2, min(64, rows), min(512, frame_height)),
+                      crop_aligned_chunk(H1, H2, min(64, cols), min(512, frame_width)))
+        elif chunks is not None:
+            if len(chunks) != 3 or any(int(n) != n or n < 1 for n in chunks):
+                raise ValueError(f"Invalid chunks {chunks}, expected 3 positive integers (frames, rows, columns)")
+        self.layout = dict(compression=compression, compression_level=level,
+                           chunks=list(chunks) if chunks is not None else None,
+                           blosc_compressor=blosc_compressor, blosc_shuffle=blosc_shuffle)
+
+    def _layout_stage_sigs(self):
+        """Return the stage_sigs of the current layout."""
+        layout = self.layout
+        sigs = [('compression', HDF5_COMPRESSION[layout['compression']])]
+        if layout['compression'] == 'zlib' and layout['compression_level'] is not None:
+            sigs.append(('zlevel', layout['compression_level']))
+        if layout['compression'] == 'blosc':
+            sigs.extend([('blosc_compressor', layout['blosc_compressor']),
+                         ('blosc_shuffle', layout['blosc_shuffle'])])
+            if layout['compression_level'] is not None:
+                sigs.append(('blosc_level', layout['compression_level']))
+        if layout['chunks'] is not None:
+            frames, rows, cols = layout['chunks']
+            sigs.extend([('num_frames_chunks', frames), ('num_row_chunks', rows), ('num_col_chunks', cols)])
+        return sigs
+
+    def _check_chunks(self):
+        """Raise ValueError if the chunks are larger than the frame, when the camera reports its size."""
+        if self.layout['chunks'] is None:
+            return
+        _, rows, cols = self.layout['chunks']
+        height = self.parent.cam.array_size.array_size_y.get()
+        width = self.parent.cam.array_size.array_size_x.get()
+        for name, n, size in (('rows', rows, height), ('columns', cols, width)):
+            if size > 0 and n > size:
+                raise ValueError(f"{self.name}: {n} {name} per chunk exceeds the {size} {name} of the frame")
+
+    def set_swmr(self, flush_frames=10):
+        """
+        Write the next acquisitions in SWMR mode, so the file can be read while it is written.
+
+        The HDF5 plugin flushes the images and the NDAttribute datasets, including the
+        AD_HDF5_DET_TS timestamps, every flush_frames frames; follow() reads them as they
+        land. The resource and datum documents are the same as without SWMR.
+
+        Parameters
+        ==========
+        flush_frames: int or None
+            Frames between flushes, or None to write without SWMR
+        """
+        if flush_frames is not None and flush_frames < 1:
+            raise ValueError(f"flush_frames must be at least 1, not {flush_frames}")
+        self.swmr_flush_frames = flush_frames
+
+    def follow(self, spec='AD_HDF5', **kwargs):
+        """
+        Yield (first frame, frames) blocks of the file being written in SWMR mode as they are flushed.
+
+        Parameters
+        ==========
+        spec: str
+            'AD_HDF5' for the images or 'AD_HDF5_DET_TS' for the detector timestamps
+        kwargs:
+            Passed to hdf5_reader.follow_dataset, e.g. stop, timeout
+        """
+        if self._fn is None:
+            raise RuntimeError(f"{self.name} is not staged")
+        return follow_dataset(str(self._fn), DATASET_KEYS[spec], **kwargs)
+
+    def _cam_dtype_changed(self, value, obj, **kwargs):
+        """Keep the cached data type current from the cam.data_type monitor, or invalidate it."""
+        try:
+            self._cam_dtype = value if isinstance(value, str) else obj.enum_strs[int(value)]
+        except (TypeError, ValueError, IndexError):
+            self._cam_dtype = None
+
     def stage(self):
         # Start the timestamp counter
         self._ts_counter = itertools.count()
+        self._ts_pending = []
+        # Subscribe before reading so a change in between still invalidates the cache
+        if self._cam_dtype_sub is None:
+            self._cam_dtype_sub = self.parent.cam.data_type.subscribe(self._cam_dtype_changed, run=False)
+        if self._cam_dtype is None:
+            self._cam_dtype = self.parent.cam.data_type.get(as_string=True)
+        for key in ('compression', 'zlevel', 'blosc_compressor', 'blosc_shuffle', 'blosc_level',
+                    'num_frames_chunks', 'num_row_chunks', 'num_col_chunks'):
+            self.stage_sigs.pop(key, None)
+        if self.layout is not None:
+            self._check_chunks()
+            # Before capture starts, which opens the file with the current layout
+            for key, value in reversed(self._layout_stage_sigs()):
+                self.stage_sigs[key] = value
+                self.stage_sigs.move_to_end(key, last=False)
+        self.stage_sigs.pop('swmr_mode', None)
+        self.stage_sigs.pop('num_frames_flush', None)
+        if self.swmr_flush_frames is not None:
+            if self.swmr_supported.get() != 'Supported':
+                raise RuntimeError(f"{self.name}: the HDF5 library of the IOC does not support SWMR")
+            # Before capture starts, the plugin only switches to SWMR when opening the file
+            self.stage_sigs['num_frames_flush'] = self.swmr_flush_frames
+            self.stage_sigs.move_to_end('num_frames_flush', last=False)
+            self.stage_sigs['swmr_mode'] = 'On'
+            self.stage_sigs.move_to_end('swmr_mode', last=False)
         return super().stage()
 
+    def unstage(self):
+        self._ts_pending = []
+        return super().unstage()
+
     def get_frames_per_point(self):
         return self.parent.cam.num_images.get()
 
@@ -105,7 +307,12 @@ class HDF5PluginWithFileStorePlain(HDF5Plugin_V22, FileStoreHDF5IterativeWrite):
         return ret
 
     def _generate_resource(self, resource_kwargs):
-        super()._generate_resource(resource_kwargs)
+        image_kwargs = dict(resource_kwargs)
+        if self.layout is not None:
+            image_kwargs.update(compression=self.layout['compression'],
+                                compression_level=self.layout['compression_level'],
+                                chunks=self.layout['chunks'])
+        super()._generate_resource(image_kwargs)
         fn = PurePath(self._fn).relative_to(self.reg_root)
 
         # Update the shape that describe() will report
@@ -132,15 +339,44 @@ class HDF5PluginWithFileStorePlain(HDF5Plugin_V22, FileStoreHDF5IterativeWrite):
         datum_kwargs.update({"point_number": next(self._ts_counter)})
         # make the timestamp datum, in this case we know they match
         datum = self._ts_datum_factory(datum_kwargs)
-        datum_id = datum["datum_id"]
 
-        # stash so that we can collect later
-        self._asset_docs_cache.append(("datum", datum))
+        # stash so that collect_asset_docs yields them together
+        self._ts_pending.append(datum)
         # put in the soft-signal so it gets auto-read later
-        self.time_stamp.put(datum_id)
+        self.time_stamp.put(datum["datum_id"])
         return ret
 
+    def collect_asset_docs(self):
+        """Yield the cached resources and image datums, then the pending timestamp datums."""
+        yield from super().collect_asset_docs()
+        ts_pending, self._ts_pending = self._ts_pending, []
+        for datum in ts_pending:
+            yield "datum", datum
+
+_STATS_PLUGINS = ('stats1', 'stats2', 'stats3', 'stats4', 'stats5')
+_ROI_PLUGINS = ('roi1', 'roi2', 'roi3', 'roi4')
+
+# Named acquisition profiles for StandardCam: the plugins kept enabled while staged, the
+# blocking_callbacks of those nothing reads and the stats plugins that are read. Plugins
+# feeding an enabled plugin through their NDArrayPort, and plugins not listed in
+# StandardCam._profile_plugins (e.g. hdf5), stay enabled.
+# The plugins read into the events, and every plugin upstream of them, always use blocking
+# callbacks, so each event's values belong to its frame. blocking_callbacks is for the other
+# enabled plugins: 'full-stats' blocks on trans1 and over1 as before, 'source-check' leaves
+# anything it does not read free running, so it cannot throttle the frame rate.
+ACQUISITION_PROFILES = {
+    'full-stats': dict(enable=_STATS_PLUGINS + _ROI_PLUGINS + ('trans1', 'over1'), read=_STATS_PLUGINS,
+                       blocking_callbacks='Yes'),
+    'source-check': dict(enable=_STATS_PLUGINS + _ROI_PLUGINS, read=_STATS_PLUGINS,
+                         blocking_callbacks='No'),
+    'fast-image-only': dict(enable=(), read=(), blocking_callbacks='No'),
+}
+
 class StandardCam(SingleTrigger, AreaDetector):#TODO is there something more standard for prosilica? seems only used on prosilica. this does stats, but no image saving (unsure if easy to configure or not and enable/disable)
+    _profile_plugins = _STATS_PLUGINS + _ROI_PLUGINS + ('trans1', 'over1')
+    # Plugins that staging leaves alone
+    _unstaged_plugins = ()
+
     stats1 = Cpt(StatsPlugin, 'Stats1:')
     stats2 = Cpt(StatsPlugin, 'Stats2:')
     stats3 = Cpt(StatsPlugin, 'Stats3:')
@@ -154,6 +390,157 @@ class StandardCam(SingleTrigger, AreaDetector):#TODO is there something more sta
     trans1 = Cpt(TransformPlugin, 'Trans1:')
     over1 = Cpt(OverlayPlugin, 'Over1:') ##for crosshairs in tiff
 
+    def __init__(self, *args, acquisition_profile=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        for name in self._unstaged_plugins:
+            getattr(self, name).stage_sigs.clear()
+        self._default_plugin_stage_sigs = {name: OrderedDict(getattr(self, name).stage_sigs)
+                                           for name in self._profile_plugins}
+        # Plugins kept enabled by the profile at the last stage, see _resolve_enabled_plugins
+        self._profile_enabled = None
+        self._profile_ports = {}
+        self._unstaged_kinds = None
+        self.acquisition_profile = None
+        if acquisition_profile is not None:
+            self.set_acquisition_profile(acquisition_profile)
+
+    def set_acquisition_profile(self, name):
+        """
+        Select the plugins enabled and read during the next acquisitions.
+
+        Parameters
+        ==========
+        name: str or None
+            Key of ACQUISITION_PROFILES, or None to stage every plugin as before
+        """
+        if name is not None and name not in ACQUISITION_PROFILES:
+            raise ValueError(f"Unknown acquisition profile {name!r}, expected one of {list(ACQUISITION_PROFILES)}")
+        self.acquisition_profile = name
+        for plugin_name, stage_sigs in self._default_plugin_stage_sigs.items():
+            plugin = getattr(self, plugin_name)
+            plugin.stage_sigs.clear()
+            plugin.stage_sigs.update(stage_sigs)
+
+    def _resolve_enabled_plugins(self, name):
+        """
+        Return the profile plugins to keep enabled: those of the profile, plus every profile
+        plugin upstream of an enabled plugin or of another plugin that staging enables (e.g. hdf5).
+
+        Only the ports of those plugins are read, never those of plugins staging leaves alone,
+        which the IOC may not load. The ports are read again at every stage, so rewiring on
+        the IOC is picked up.
+        """
+        profile_plugins = {n: getattr(self, n) for n in self._profile_plugins}
+        self._profile_ports = {plugin.port_name.get(): n for n, plugin in profile_plugins.items()}
+        staged = [n for n in self.component_names
+                  if n not in profile_plugins and isinstance(getattr(self, n), PluginBase)
+                  and getattr(self, n).stage_sigs.get('enable')]
+        enabled = set(ACQUISITION_PROFILES[name]['enable'])
+        return enabled | self._upstream_plugins(list(enabled) + staged)
+
+    def _upstream_plugins(self, names):
+        """Return the profile plugins upstream of the named plugins, from the ports of the last resolve."""
+        found = set()
+        pending = list(names)
+        while pending:
+            upstream = self._profile_ports.get(getattr(self, pending.pop()).nd_array_port.get())
+            if upstream is not None and upstream not in found:
+                found.add(upstream)
+                pending.append(upstream)
+        return found
+
+    def stage(self):
+        if self.acquisition_profile is not None:
+            profile = ACQUISITION_PROFILES[self.acquisition_profile]
+            enabled = self._profile_enabled = self._resolve_enabled_plugins(self.acquisition_profile)
+            # Values read into the events must be final when acquire drops
+            blocking = set(profile['read']) | self._upstream_plugins(profile['read'])
+            for plugin_name in self._profile_plugins:
+                plugin = getattr(self, plugin_name)
+                plugin.stage_sigs.clear()
+                if plugin_name in enabled:
+                    # Enabled plugins keep the ophyd defaults, with the profile's blocking callbacks
+                    plugin.stage_sigs.update(self._default_plugin_stage_sigs[plugin_name])
+                    plugin.stage_sigs['blocking_callbacks'] = ('Yes' if plugin_name in blocking
+                                                               else profile['blocking_callbacks'])
+                else:
+                    # A disabled plugin only needs turning off, nothing else is staged
+                    plugin.stage_sigs['enable'] = 0
+            read = profile['read']
+            self._unstaged_kinds = {n: getattr(self, n).kind for n in _STATS_PLUGINS}
+            for plugin_name in _STATS_PLUGINS:
+                if plugin_name not in read:
+                    getattr(self, plugin_name).kind = Kind.omitted
+        return super().stage()
+
+    def unstage(self):
+        ret = super().unstage()
+        if self._unstaged_kinds is not None:
+            for plugin_name, kind in self._unstaged_kinds.items():
+                getattr(self, plugin_name).kind = kind
+            self._unstaged_kinds = None
+        return ret
+
+class StandardCamWithPva(StandardCam):
+    """
+    StandardCam with a PVA plugin streaming live frames, see start_live_stream.
+
+    Only use it on IOCs that load Pva1. The plugin is switched by start_live_stream and
+    stop_live_stream, never by staging.
+    """
+    _unstaged_plugins = StandardCam._unstaged_plugins + ('pva1',)
+
+    pva1 = Cpt(PvaPlugin_V25, 'Pva1:', kind='omitted') ##live frames
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._live_stream = None
+
+    def live_rois(self):
+        """Return the current (x, y, width, height) of the ROI plugins."""
+        return [(roi.min_xyz.min_x.get(), roi.min_xyz.min_y.get(), roi.size.x.get(), roi.size.y.get())
+                for roi in (getattr(self, name) for name in _ROI_PLUGINS)]
+
+    def start_live_stream(self, maxlen=16, rois=None, on_update=None):
+        """
+        Enable the PVA plugin and stream its frames into a bounded ring.
+
+        Every frame gets the statistics of compute_roi_stats for the ROIs under 'stats',
+        for live ROI sums and centroids during alignment.
+
+        Parameters
+        ==========
+        maxlen: int
+            Number of recent frames kept
+        rois: list
+            (x, y, width, height) tuples, by default the current ROI plugin geometry
+        on_update: callable
+            Called with each new entry, see LiveFrameStream
+
+        Returns
+        =======
+        LiveFrameStream
+        """
+        self.stop_live_stream()
+        if rois is None:
+            rois = self.live_rois()
+
+        def analyze(image):
+            return {key: value[0] for key, value in compute_roi_stats([image], rois).items()}
+
+        self.pva1.enable.put(1)
+        self._live_stream = LiveFrameStream(self.pva1.pv_name.get(), maxlen=maxlen,
+                                            analyze=analyze if len(rois) else None, on_update=on_update)
+        return self._live_stream.start()
+
+    def stop_live_stream(self, disable=True):
+        """Stop the live stream, if any, and disable the PVA plugin unless disable is False."""
+        if self._live_stream is not None:
+            self._live_stream.stop()
+            self._live_stream = None
+            if disable:
+                self.pva1.enable.put(0)
+
 class StandardProsilicaWithHDF5(StandardCam):
     hdf5 = Cpt(HDF5PluginWithFileStorePlain,
               suffix='HDF1:',
@@ -164,6 +551,107 @@ class StandardProsilicaWithHDF5(StandardCam):
         super().__init__(*args, **kwargs)
         self.hdf5.kind = "normal"
 
+class StandardProsilicaWithPretrigger(StandardProsilicaWithHDF5):
+    """
+    StandardProsilicaWithHDF5 that captures frames around an event with the circular buffer plugin.
+
+    While staged the camera acquires continuously into CB1, which feeds the HDF5 plugin.
+    Each trigger() arms the buffer, waits until it holds pre_count frames, and when
+    event_signal changes to event_value (e.g. FE_shutter.status reaching 'Not Closed')
+    flushes the pre_count frames before and post_count frames after the event to HDF5.
+    With no event_signal the buffer is triggered as soon as it is full. The frames are
+    one datum of pre_count + post_count frames, as with the other cameras. A trigger()
+    without the event fails after event_timeout seconds, 60 by default.
+    """
+    cb = Cpt(CircularBuffPlugin_V34, 'CB1:')
+
+    def __init__(self, *args, event_signal=None, event_value='Not Closed',
+                 pre_count=10, post_count=10, event_timeout=60, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.event_signal = event_signal
+        self.event_value = event_value
+        self.pre_count = pre_count
+        self.post_count = post_count
+        # Timeout in seconds of each trigger(), None waits for the event forever
+        self.event_timeout = event_timeout
+        self._trigger_subs = []
+
+    def stage(self):
+        frames = self.pre_count + self.post_count
+        # Continuous acquisition; num_images only sets the frames per point of the HDF5 resource
+        self.stage_sigs.update([('cam.image_mode', 2), ('cam.num_images', frames)])
+        self.cb.stage_sigs.update([('pre_count', self.pre_count), ('post_count', self.post_count),
+                                   ('preset_trigger_count', 1)])
+        self.hdf5.stage_sigs['nd_array_port'] = self.cb.port_name.get()
+        ret = super().stage()
+        self.cam.acquire.put(1, wait=False)
+        return ret
+
+    def unstage(self):
+        self._clear_trigger_subs()
+        self.cb.capture.put(0)
+        self.cam.acquire.put(0)
+        return super().unstage()
+
+    def _clear_trigger_subs(self, *args):
+        for sig, cid in self._trigger_subs:
+            sig.unsubscribe(cid)
+        self._trigger_subs = []
+
+    def trigger(self):
+        "Arm the circular buffer and capture the frames around the next event."
+        if self._staged != Staged.yes:
+            raise RuntimeError("This detector is not ready to trigger."
+                               "Call the stage() method before triggering.")
+        self._clear_trigger_subs()
+        st = DeviceStatus(self, timeout=self.event_timeout)
+        expected = self.hdf5.num_captured.get() + self.pre_count + self.post_count
+        armed = fired = False
+        # Callbacks run on the monitor thread and once from here
+        lock = threading.Lock()
+
+        def fire():
+            nonlocal fired
+            with lock:
+                if fired:
+                    return
+                fired = True
+            self.cb.trigger_.put(1, wait=False)
+
+        def event_cb(value, old_value=None, **kwargs):
+            # Only a change into event_value counts, not a state it was already in
+            if value == self.event_value and old_value != self.event_value:
+                fire()
+
+        def buffer_cb(value, **kwargs):
+            nonlocal armed
+            with lock:
+                if armed or value < self.pre_count:
+                    return
+                armed = True
+            if self.event_signal is None:
+                fire()
+            else:
+                self._trigger_subs.append(
+                    (self.event_signal, self.event_signal.subscribe(event_cb, run=False)))
+
+        def captured_cb(value, **kwargs):
+            with lock:
+                if not fired or value < expected or st.done:
+                    return
+                st.set_finished()
+
+        st.add_callback(self._clear_trigger_subs)
+        self.cb.capture.put(1, wait=True)
+        # Only fresh buffer counts, the cached value may be left from the previous capture
+        for sig, cb in ((self.hdf5.num_captured, captured_cb), (self.cb.current_qty, buffer_cb)):
+            self._trigger_subs.append((sig, sig.subscribe(cb, run=False)))
+        # The buffer may already hold pre_count frames, then no further monitor arrives;
+        # read it past the monitor cache, which may still hold the previous capture
+        buffer_cb(self.cb.current_qty.get(use_monitor=False))
+        self.generate_datum(self._image_name, ttime.time(), {})
+        return st
+
 def add_cam_rois(cam):
     for k in (f'stats{j}' for j in range(1, 6)):
         cam.read_attrs.append(k)
@@ -212,12 +700,30 @@ class EPSTwoStateDevice(Device):
         cmd_sig = cmd_map[val]
         target_val = target_map[val]
 
-        st = self._set_st = DeviceStatus(self)
+        st = self._set_st = DeviceStatus(self, timeout=self.set_timeout)
         enums = self.status.enum_strs
+        transition = dict(direction=val, command_time=ttime.time(), retry_times=[],
+                          status_time=None, outcome=None)
+        # The monitor thread and set() itself may both try to finish st
+        finish_lock = threading.Lock()
+
+        def finish(status_time):
+            with finish_lock:
+                if st.done:
+                    return
+                if status_time is None:
+                    # Already in the target state, nothing to time
+                    transition['outcome'] = 'no change'
+                transition['status_time'] = status_time
+                # This was a race condition, fixed.
+                # First clear self._set_st to allow future moves to start,
+                # and _then_ mark the current move as done.
+                self._clear_set(st)
+                st.set_finished()
 
         # Called when a change in self.status has been detected
         # Used to set the shutter up for the next movement
-        def shutter_cb(value, timestamp, **kwargs):
+        def shutter_cb(value, **kwargs):
             
             try:
                 value = enums[int(value)]
@@ -226,18 +732,21 @@ class EPSTwoStateDevice(Device):
                 # just move on
                 ...
             if value == target_val:
-                self.status.clear_sub(shutter_cb)
-                cmd_sig.clear_sub(cmd_retry_cb)
-                # This was a race condition, fixed.
-                # First clear self._set_st to allow future moves to start,
-                # and _then_ mark the current move as done.
-                self._set_st = None
-                st.set_finished()
+                # Local receive time, the same clock as command_time
+                finish(ttime.time())
 
         cmd_enums = cmd_sig.enum_strs
         count = 0
-        MAX_RETRIES = 10
-        WAIT_FOR_RETRY = 0.5  # seconds
+
+        # Runs on a timer thread so the CA monitor dispatch thread is never blocked
+        def retry():
+            if not st.done:
+                # Retry setting the command to 1.
+                transition['retry_times'].append(ttime.time())
+                cmd_sig.put(1)
+                ts = datetime.datetime.now().strftime(_time_fmtstr)
+                print('** ({}) Had to reactuate shutter while {}ing'.format(ts, val))
+
         def cmd_retry_cb(value, timestamp, **kwargs):
             nonlocal count
             try:
@@ -247,28 +756,144 @@ class EPSTwoStateDevice(Device):
                 # just move on
                 ...
 
+            if value != 'None' or st.done:
+                return
             count += 1
-            if count > MAX_RETRIES:
-                cmd_sig.clear_sub(cmd_retry_cb)
-                err = Exception(f"Retried {MAX_RETRIES} times and did not finish.")
-                st.set_exception(err)
-            if value == 'None':
-                ttime.sleep(WAIT_FOR_RETRY)
-                if not st.done:
-                    # Retry setting the command to 1.
-                    cmd_sig.set(1)
-                    ts = datetime.datetime.fromtimestamp(timestamp).strftime(_time_fmtstr)
-                    print('** ({}) Had to reactuate shutter while {}ing'.format(ts, val))
-
-        cmd_sig.subscribe(cmd_retry_cb, run=False)
-        self.status.subscribe(shutter_cb)
-        cmd_sig.set(1)
+            if count > self.max_retries:
+                with finish_lock:
+                    if st.done:
+                        return
+                    transition['outcome'] = 'retries exhausted'
+                    self._clear_set(st)
+                    st.set_exception(Exception(f"Retried {self.max_retries} times and did not finish."))
+                return
+            delay = self.retry_delay * self.retry_backoff ** (count - 1)
+            # Only one re-actuation is pending at a time, so _clear_set can always cancel it
+            if self._retry_timer is not None:
+                self._retry_timer.cancel()
+            self._retry_timer = threading.Timer(delay, retry)
+            self._retry_timer.daemon = True
+            self._retry_timer.start()
+
+        # run=False: the initial value would finish st with a stale completion time
+        self._set_subs = [(cmd_sig, cmd_sig.subscribe(cmd_retry_cb, run=False)),
+                          (self.status, self.status.subscribe(shutter_cb, run=False))]
+        # Clean up after a timeout or any other failure
+        st.add_callback(self._clear_set)
+        st.add_callback(partial(self._record_transition, transition))
+        if self.status.get() == target_val:
+            finish(None)
+        cmd_sig.put(1)
 
         return st
 
+    def _clear_set(self, st):
+        """Remove the subscriptions and pending retry of the set that returned st."""
+        if self._set_st is not st:
+            return
+        if self._retry_timer is not None:
+            self._retry_timer.cancel()
+            self._retry_timer = None
+        for sig, cid in self._set_subs:
+            sig.unsubscribe(cid)
+        self._set_subs = []
+        self._set_st = None
+
+    def stop(self, *, success=False):
+        """Cancel a set in progress, including any scheduled retry."""
+        st = self._set_st
+        if st is not None:
+            self._clear_set(st)
+            if not st.done:
+                st.set_exception(RuntimeError(f"{self.name} set was stopped"))
+        super().stop(success=success)
+
+    def _record_transition(self, transition, st):
+        """Complete a transition record when its status finishes and add it to the history."""
+        if transition['outcome'] is None:
+            if st.success:
+                transition['outcome'] = 'success'
+            elif isinstance(st.exception(), StatusTimeoutError):
+                transition['outcome'] = 'timeout'
+            else:
+                transition['outcome'] = 'stopped'
+        transition['retries'] = len(transition['retry_times'])
+        if transition['status_time'] is not None:
+            transition['latency'] = transition['status_time'] - transition['command_time']
+        else:
+            transition['latency'] = float('nan')
+        self.transitions.append(transition)
+
+    def latency_summary(self, percentiles=(50, 95, 99)):
+        """
+        Summarize the latency of the successful transitions in the history.
+
+        Parameters
+        ==========
+        percentiles: tuple of float
+            Percentiles to compute for each direction
+
+        Returns
+        =======
+        dict
+            Maps each command string, state1_str or state2_str, to the number of timed
+            transitions, failures, retries and the latency percentiles in seconds, e.g.
+            {'Opn': {'n': 12, 'p50': 1.8, ...}, 'Cls': {...}} for FE_shutter.
+            Sets on a shutter already in the requested state are not counted.
+        """
+        summary = {}
+        for direction in (self.state1_str, self.state2_str):
+            records = [t for t in list(self.transitions) if t['direction'] == direction]
+            latencies = [t['latency'] for t in records if t['outcome'] == 'success']
+            entry = dict(n=len(latencies), failures=sum(t['outcome'] not in ('success', 'no change') for t in records),
+                         retries=sum(t['retries'] for t in records))
+            for q, value in zip(percentiles, np.percentile(latencies, percentiles) if latencies
+                                else [float('nan')] * len(percentiles)):
+                entry[f'p{q:g}'] = float(value)
+            summary[direction] = entry
+        return summary
+
+    def export_transitions(self, path):
+        """Write the transition history to a tab separated text file, one transition per line."""
+        with open(path, 'w') as f:
+            f.write('command_time\tdirection\toutcome\tlatency\tretries\tretry_times\n')
+            for t in list(self.transitions):
+                command_time = datetime.datetime.fromtimestamp(t['command_time']).strftime(_time_fmtstr)
+                retry_times = ','.join(f"{r - t['command_time']:.3f}" for r in t['retry_times'])
+                f.write(f"{command_time}\t{t['direction']}\t{t['outcome']}\t{t['latency']:.3f}"
+                        f"\t{t['retries']}\t{retry_times}\n")
+
+    def transition_documents(self, metadata=None):
+        """
+        Yield the transition history as bluesky (name, document) pairs.
+
+        One event is emitted per transition in a 'transitions' stream, so the history can
+        be inserted into databroker or passed to any RunEngine subscriber.
+        """
+        md = {'plan_name': 'shutter_transitions', 'detectors': [self.name]}
+        md.update(metadata or {})
+        run = event_model.compose_run(metadata=md)
+        yield 'start', run.start_doc
+        data_keys = {
+            'direction': dict(source=self.name, dtype='string', shape=[]),
+            'outcome': dict(source=self.name, dtype='string', shape=[]),
+            'command_time': dict(source=self.name, dtype='number', shape=[], units='s'),
+            'latency': dict(source=self.name, dtype='number', shape=[], units='s'),
+            'retries': dict(source=self.name, dtype='integer', shape=[]),
+        }
+        desc = run.compose_descriptor(name='transitions', data_keys=data_keys)
+        yield 'descriptor', desc.descriptor_doc
+        for t in list(self.transitions):
+            data = {key: t[key] for key in data_keys}
+            yield 'event', desc.compose_event(data=data, timestamps={key: t['command_time'] for key in data},
+                                              time=t['command_time'])
+        yield 'stop', run.compose_stop()
+
     def __init__(self, *args, state1, state2,
                  cmd_str1, cmd_str2,
-                 nm_str1, nm_str2, **kwargs):
+                 nm_str1, nm_str2,
+                 retry_delay=0.5, retry_backoff=1.0, max_retries=10,
+                 set_timeout=None, history_length=1000, **kwargs):
 
         self._state1_nm = nm_str1
         self._state2_nm = nm_str2
@@ -276,6 +901,16 @@ class EPSTwoStateDevice(Device):
         super().__init__(*args, **kwargs)
 
         self._set_st = None
+        self._set_subs = []
+        self._retry_timer = None
+        # Seconds before the first re-actuation, multiplied by retry_backoff for each further one
+        self.retry_delay = retry_delay
+        self.retry_backoff = retry_backoff
+        self.max_retries = max_retries
+        # Overall timeout in seconds for a set, None waits forever
+        self.set_timeout = set_timeout
+        # Ring buffer of the most recent transitions, see latency_summary
+        self.transitions = deque(maxlen=history_length)
         self.read_attrs = ['status']
 
         self.state1_str = cmd_str1
@@ -442,8 +1077,35 @@ bpm = BPM('XF:23ID-ID{BPM}Val:', name = 'bpm') # startup/accelerator (DONE)
 
 
 # Fluo Screen 1 HDF5 Camera (copied from csx1/startup/detectors.py)
-cam_fs1_hdf5 = add_cam_rois(StandardProsilicaWithHDF5('XF:23IDA-BI:1{FS:1-Cam:1}', name = 'cam_fs1_hdf5'))
+cam_fs1_hdf5 = add_cam_rois(StandardProsilicaWithHDF5('XF:23IDA-BI:1{FS:1-Cam:1}', name = 'cam_fs1_hdf5',
+                                                      acquisition_profile='source-check'))
+
+
+def get_ROI_geometry(num_rois, header, H1=0, V1=0):
+    """ Reads the ROI rectangles from the camera configuration in the header.
+
+    Parameters:
+    ----------
+    num_rois : int
+        Number of ROIs to read.
+    header : Header
+        The scan header containing the camera configuration.
+    H1 : int, optional
+        Horizontal offset to adjust the ROI positions (default is 0).
+    V1 : int, optional
+        Vertical offset to adjust the ROI positions (default is 0).
+    Returns:
+    -------
+    list
+        List of (x, y, width, height) tuples, one per ROI.
+    """
+    cam_name = header.start['detectors'][0]
+    cam_config = header.descriptors[0]['configuration'][cam_name]['data']
 
+    return [(cam_config[f'{cam_name}_roi{i}_min_xyz_min_x'] - H1,
+             cam_config[f'{cam_name}_roi{i}_min_xyz_min_y'] - V1,
+             cam_config[f'{cam_name}_roi{i}_size_x'],
+             cam_config[f'{cam_name}_roi{i}_size_y']) for i in range(1, num_rois + 1)]
 
 def make_ROI_patches(num_patches, header, H1=0, V1=0):
     """ Creates a list of ROI patches based on the camera configuration in the header.
@@ -463,16 +1125,9 @@ def make_ROI_patches(num_patches, header, H1=0, V1=0):
     list
         List of matplotlib.patches.Rectangle objects representing the ROIs.
     """
-    cam_name = header.start['detectors'][0]
-    cam_config = header.descriptors[0]['configuration'][cam_name]['data']
-
     patch_lst = []
 
-    for i in range(1, num_patches + 1):
-        x = cam_config[f'{cam_name}_roi{i}_min_xyz_min_x'] - H1
-        y = cam_config[f'{cam_name}_roi{i}_min_xyz_min_y'] - V1
-        width = cam_config[f'{cam_name}_roi{i}_size_x']
-        height = cam_config[f'{cam_name}_roi{i}_size_y']
+    for i, (x, y, width, height) in enumerate(get_ROI_geometry(num_patches, header, H1=H1, V1=V1), start=1):
         patch_lst.append( patches.Rectangle((x, y), width, height, linewidth=1, edgecolor='aquamarine', facecolor='none', label = f'ROI{i}'))
 
     return patch_lst
@@ -507,6 +1162,127 @@ def remove_patches(patch_references):
     for patch_ref in patch_references:
         patch_ref.remove()
 
+# Crop window (V1, V2, H1, H2) of the fluoscreen images
+FLUO_CROP = (460, 960, 1340, 1490)
+
+def average_frames(frames, crop=FLUO_CROP):
+    """ Computes the mean and variance of a stream of frames, cropping each one before conversion.
+
+    Frames are read one at a time and combined into a running float64 mean and
+    variance, so only one cropped frame is held in memory at once.
+
+    Parameters:
+    ----------
+    frames : iterable
+        Frames of shape (..., rows, columns), e.g. the events from header.data.
+        Leading dimensions, such as several frames per event, are averaged as well.
+    crop : tuple of int or None, optional
+        Crop window (V1, V2, H1, H2) applied to each frame (default is FLUO_CROP).
+        None keeps the whole frame.
+
+    Returns:
+    -------
+    mean : numpy.ndarray
+        Mean of the cropped frames.
+    var : numpy.ndarray
+        Population variance of the cropped frames.
+    n : int
+        Number of frames averaged.
+    """
+    n = 0
+    mean = m2 = None
+    for frame in frames:
+        if crop is not None:
+            V1, V2, H1, H2 = crop
+            frame = frame[..., V1:V2, H1:H2]
+        block = np.asarray(frame, dtype=np.float64)
+        block = block.reshape((-1,) + block.shape[-2:])
+        n_b = block.shape[0]
+        mean_b = block.mean(axis=0)
+        m2_b = ((block - mean_b) ** 2).sum(axis=0)
+        if mean is None:
+            n, mean, m2 = n_b, mean_b, m2_b
+            continue
+        # Combine the running and block statistics (Chan et al.)
+        delta = mean_b - mean
+        total = n + n_b
+        mean += delta * (n_b / total)
+        m2 += m2_b + delta ** 2 * (n * n_b / total)
+        n = total
+    if mean is None:
+        raise ValueError("No frames to average")
+    return mean, m2 / n, n
+
+# LRU cache of averaged images, keyed by (run uid, crop window)
+IMAGE_CACHE_MAX_BYTES = 512 * 2**20
+_image_cache = OrderedDict()
+_image_cache_stats = {"hits": 0, "misses": 0, "evictions": 0, "bytes": 0}
+_image_cache_lock = threading.Lock()
+
+def image_cache_info():
+    """ Returns the hit, miss and eviction counters, the number of entries and the bytes held by the image cache. """
+    with _image_cache_lock:
+        return dict(_image_cache_stats, size=len(_image_cache), max_bytes=IMAGE_CACHE_MAX_BYTES)
+
+def clear_image_cache():
+    """ Empties the image cache and resets its counters. """
+    with _image_cache_lock:
+        _image_cache.clear()
+        _image_cache_stats.update(hits=0, misses=0, evictions=0, bytes=0)
+
+def _cache_image(key, entry):
+    """ Stores an (mean, var, n) entry and evicts the least recently used ones beyond IMAGE_CACHE_MAX_BYTES. """
+    nbytes = entry[0].nbytes + entry[1].nbytes
+    if nbytes > IMAGE_CACHE_MAX_BYTES:
+        return
+    with _image_cache_lock:
+        if key in _image_cache:
+            return
+        _image_cache[key] = entry
+        _image_cache_stats['bytes'] += nbytes
+        while _image_cache_stats['bytes'] > IMAGE_CACHE_MAX_BYTES:
+            _, (mean, var, _) = _image_cache.popitem(last=False)
+            _image_cache_stats['bytes'] -= mean.nbytes + var.nbytes
+            _image_cache_stats['evictions'] += 1
+
+def average_image(header, crop=FLUO_CROP, use_cache=True):
+    """ Returns the mean and variance of the cropped camera images in a scan header.
+
+    Results are kept in an LRU cache keyed by run uid and crop window, so the same
+    scan is only read once. The cached arrays are read-only.
+
+    Parameters:
+    ----------
+    header : Header
+        The scan header containing the image data.
+    crop : tuple of int or None, optional
+        Crop window (V1, V2, H1, H2) (default is FLUO_CROP).
+    use_cache : bool, optional
+        Whether to look up and store the result in the image cache (default is True).
+
+    Returns:
+    -------
+    mean, var, n
+        See average_frames.
+    """
+    key = (header.start['uid'], tuple(crop) if crop is not None else None)
+    if use_cache:
+        with _image_cache_lock:
+            entry = _image_cache.get(key)
+            if entry is not None:
+                _image_cache.move_to_end(key)
+            _image_cache_stats["hits" if entry is not None else "misses"] += 1
+        if entry is not None:
+            return entry
+
+    cam_name = header.start['detectors'][0]
+    mean, var, n = average_frames(header.data(f'{cam_name}_image'), crop=crop)
+    if use_cache:
+        mean.setflags(write=False)
+        var.setflags(write=False)
+        _cache_image(key, (mean, var, n))
+    return mean, var, n
+
 # Add ROIs to the image plot
 def plot_img_with_ROI(header, title='Image with ROIs'):
     """ Plots a fluoscreen image from the scan header and adds ROI patches.
@@ -525,11 +1301,10 @@ def plot_img_with_ROI(header, title='Image with ROIs'):
     patch_references : list  
         List of patch references for the added ROIs.
     """
-    V1, V2, H1, H2 = 460, 960, 1340, 1490
+    V1, V2, H1, H2 = FLUO_CROP
     fig, ax = plt.subplots(1, figsize=(5, 5) ) 
-    cam_name = header.start['detectors'][0]
-    img = np.mean(np.squeeze(np.array(list(header.data(f'{cam_name}_image')))), axis=0)
-    im = ax.imshow(img[V1:V2, H1:H2], vmin =7500, vmax = 15_000, aspect='auto')
+    img, _, _ = average_image(header)
+    im = ax.imshow(img, vmin =7500, vmax = 15_000, aspect='auto')
     plt.colorbar(im, ax=ax, shrink = .3)
     patch_lst = make_ROI_patches(4, header, H1=H1, V1=V1)
     patch_references = add_patches(patch_lst, ax)
@@ -555,30 +1330,328 @@ def compare_images(h1, h2):
         The second scan header containing the image data and ROI configuration.
     """
 
-    V1, V2, H1, H2 = 460, 960, 1340, 1490
+    V1, V2, H1, H2 = FLUO_CROP
     fig, axes = plt.subplots(1,3, figsize=(10, 3) )
-    cam_name = h1.start['detectors'][0]
     headers = [h1, h2]
     images = []
     for i in range(0, 2):
         ax = axes[i]
         header = headers[i]
-        img = np.mean(np.squeeze(np.array(list(header.data(f'{cam_name}_image')))), axis=0)
+        img, _, _ = average_image(header)
         images.append(img)
-        im = ax.imshow(img[V1:V2, H1:H2], vmin =7500, vmax = 15_000, aspect='auto')
+        im = ax.imshow(img, vmin =7500, vmax = 15_000, aspect='auto')
         plt.colorbar(im, ax=ax, shrink = .3)
         patch_lst = make_ROI_patches(4, header, H1=H1, V1=V1)
         add_patches(patch_lst, ax)
         ax.set(title=f'Image {i + 1}')
         ax.axis('off')
 
+    rois = get_ROI_geometry(4, h1, H1=H1, V1=V1)
+    result = estimate_beam_shifts(images[0], images[1:], rois=rois)[0]
+
     ax = axes[2]
-    im = ax.imshow((images[1] - images[0])[V1:V2, H1:H2], aspect='auto',)
+    im = ax.imshow(images[1] - images[0], aspect='auto',)
     plt.colorbar(im, ax=ax, shrink = .3)
     patch_lst = make_ROI_patches(4, header, H1=H1, V1=V1)
     add_patches(patch_lst, ax)
     ax.axis('off')
-    ax.set(title=f'Difference\n Observable X-angle Shift')
+    dy, dx = result['shift']
+    ax.set(title=f'Difference\n Shift x={dx:.2f} px, y={dy:.2f} px')
+    return result
+
+def _tukey(n, alpha=0.25):
+    """ Returns a Tukey window, flat in the middle with cosine tapers over alpha of its length. """
+    window = np.ones(n)
+    k = int(alpha * n / 2)
+    if k:
+        taper = 0.5 * (1 - np.cos(np.pi * np.arange(k) / k))
+        window[:k] = taper
+        window[n - k:] = taper[::-1]
+    return window
+
+def _fft_of(img):
+    """ Returns the 2D FFT of an image after removing its mean and tapering its edges. """
+    img = np.asarray(img, dtype=np.float64)
+    window = np.outer(_tukey(img.shape[0]), _tukey(img.shape[1]))
+    return np.fft.rfft2((img - img.mean()) * window)
+
+def _parabolic_peak(c_minus, c_0, c_plus):
+    """ Returns the sub-pixel offset of a peak from three neighbouring samples. """
+    denom = c_minus - 2 * c_0 + c_plus
+    return 0.0 if denom == 0 else 0.5 * (c_minus - c_plus) / denom
+
+def phase_correlation_shift(ref_fft, img, shape=None):
+    """ Estimates the sub-pixel translation of an image relative to a reference by phase correlation.
+
+    Parameters:
+    ----------
+    ref_fft : numpy.ndarray
+        FFT of the reference image as returned by _fft_of, computed once per reference.
+    img : numpy.ndarray
+        Image to compare, of the same shape as the reference.
+    shape : tuple of int, optional
+        Shape of the images (default is img.shape).
+    Returns:
+    -------
+    tuple of float
+        (dy, dx) in pixels, such that img is the reference moved down by dy and right by dx.
+    """
+    shape = shape or np.shape(img)
+    cross = _fft_of(img) * np.conj(ref_fft)
+    # Whitening with a floor, so noisy frequencies without beam content do not dominate the peak
+    magnitude = np.abs(cross)
+    cross /= magnitude + 1e-2 * magnitude.max() + np.finfo(float).tiny
+    corr = np.fft.irfft2(cross, s=shape)
+    peak = np.unravel_index(np.argmax(corr), corr.shape)
+
+    shift = []
+    for axis, p in enumerate(peak):
+        n = corr.shape[axis]
+        neighbours = [corr[tuple((p + d) % n if a == axis else peak[a] for a in range(2))] for d in (-1, 0, 1)]
+        s = p + _parabolic_peak(*neighbours)
+        # Peaks past the middle are negative shifts
+        shift.append(s - n if s > n / 2 else s)
+    return tuple(shift)
+
+def _fwhm(profile):
+    """ Returns the full width at half maximum of a 1D profile above its minimum, in pixels. """
+    profile = profile - profile.min()
+    peak = int(np.argmax(profile))
+    half = profile[peak] / 2
+    if half <= 0:
+        return float('nan')
+    below_left = np.flatnonzero(profile[:peak] < half)
+    below_right = np.flatnonzero(profile[peak:] < half)
+    if not len(below_left) or not len(below_right):
+        return float('nan')
+    i = below_left[-1]
+    left = i + (half - profile[i]) / (profile[i + 1] - profile[i])
+    j = peak + below_right[0]
+    right = j - 1 + (profile[j - 1] - half) / (profile[j - 1] - profile[j])
+    return float(right - left)
+
+def roi_beam_stats(img, rois):
+    """ Computes the centroid, FWHM and integrated intensity of the image inside each ROI.
+
+    Parameters:
+    ----------
+    img : numpy.ndarray
+        Averaged 2D image.
+    rois : list
+        List of (x, y, width, height) tuples in image coordinates, see get_ROI_geometry.
+    Returns:
+    -------
+    list
+        One dict per ROI with keys 'roi', 'integrated', 'centroid_x', 'centroid_y',
+        'fwhm_x' and 'fwhm_y'. Positions are in image pixels.
+    """
+    stats = []
+    for i, (x, y, width, height) in enumerate(rois, start=1):
+        x0, y0 = max(int(x), 0), max(int(y), 0)
+        sub = np.asarray(img[y0:int(y + height), x0:int(x + width)], dtype=np.float64)
+        entry = dict(roi=f'ROI{i}', integrated=float(sub.sum()), centroid_x=float('nan'),
+                     centroid_y=float('nan'), fwhm_x=float('nan'), fwhm_y=float('nan'))
+        if sub.size:
+            # Subtract the background, estimated from the ROI border, so the dark level
+            # does not pull the centroid to the ROI centre
+            border = np.concatenate([sub[0], sub[-1], sub[:, 0], sub[:, -1]])
+            weights = np.clip(sub - np.median(border), 0, None)
+            profile_x, profile_y = weights.sum(axis=0), weights.sum(axis=1)
+            total = profile_x.sum()
+            if total > 0:
+                entry['centroid_x'] = x0 + float(profile_x @ np.arange(len(profile_x)) / total)
+                entry['centroid_y'] = y0 + float(profile_y @ np.arange(len(profile_y)) / total)
+            entry['fwhm_x'], entry['fwhm_y'] = _fwhm(profile_x), _fwhm(profile_y)
+        stats.append(entry)
+    return stats
+
+def estimate_beam_shifts(reference, images, rois=()):
+    """ Estimates the beam shift and ROI statistics of several images against one reference.
+
+    The FFT of the reference is computed once and reused for every image.
+
+    Parameters:
+    ----------
+    reference : numpy.ndarray
+        Averaged, cropped reference image, e.g. from average_image.
+    images : list of numpy.ndarray
+        Images to compare, each of the same shape as the reference.
+    rois : list, optional
+        List of (x, y, width, height) tuples in image coordinates (default is no ROIs).
+    Returns:
+    -------
+    list
+        One dict per image with keys 'shift' ((dy, dx) in pixels), 'rois' (see
+        roi_beam_stats), 'reference' (the same statistics for the reference) and
+        'roi_shifts' (centroid changes (dy, dx) per ROI).
+    """
+    ref_fft = _fft_of(reference)
+    ref_stats = roi_beam_stats(reference, rois)
+    results = []
+    for img in images:
+        stats = roi_beam_stats(img, rois)
+        roi_shifts = [(s['centroid_y'] - r['centroid_y'], s['centroid_x'] - r['centroid_x'])
+                      for s, r in zip(stats, ref_stats)]
+        results.append(dict(shift=phase_correlation_shift(ref_fft, img, shape=np.shape(reference)),
+                            rois=stats, reference=ref_stats, roi_shifts=roi_shifts))
+    return results
+
+def compare_runs(reference_header, headers, num_rois=4, crop=FLUO_CROP):
+    """ Estimates the beam shift of several scans against a reference scan.
+
+    Parameters:
+    ----------
+    reference_header : Header
+        The reference scan header.
+    headers : list of Header
+        Scan headers to compare with the reference.
+    num_rois : int, optional
+        Number of ROIs to analyse (default is 4).
+    crop : tuple of int, optional
+        Crop window (V1, V2, H1, H2) (default is FLUO_CROP).
+    Returns:
+    -------
+    list
+        One result per header, see estimate_beam_shifts, with the run uid under 'uid'.
+    """
+    V1, V2, H1, H2 = crop
+    reference, _, _ = average_image(reference_header, crop=crop)
+    rois = get_ROI_geometry(num_rois, reference_header, H1=H1, V1=V1)
+    results = estimate_beam_shifts(reference, (average_image(h, crop=crop)[0] for h in headers), rois=rois)
+    for header, result in zip(headers, results):
+        result['uid'] = header.start['uid']
+    return results
+
+def _batches(frames, batch_size):
+    """ Yields lists of at most batch_size frames from a stream of (possibly multi-frame) events. """
+    batch = []
+    for event in frames:
+        # Several frames per event come as a leading dimension
+        for frame in (event if np.ndim(event) > 2 else [event]):
+            batch.append(frame)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+def compute_roi_stats(frames, rois, batch_size=64):
+    """ Computes the sum, mean, max, centroid and sigma of every ROI in every frame.
+
+    Frames are cropped to the bounding box of the ROIs and processed in batches. The
+    column and row integral images of the batch give the x and y projections of every
+    ROI with two lookups each, and the sums and first and second moments follow from
+    the projections. Centroid and sigma use the raw intensities, like StatsPlugin
+    without background subtraction.
+
+    Parameters:
+    ----------
+    frames : iterable
+        Frames or events of shape (..., rows, columns), e.g. header.data or an HDF5FrameView.
+    rois : list
+        List of (x, y, width, height) tuples in frame coordinates, see get_ROI_geometry.
+    batch_size : int, optional
+        Number of frames converted and processed together (default is 64).
+    Returns:
+    -------
+    dict
+        Maps 'sum', 'mean', 'max', 'centroid_x', 'centroid_y', 'sigma_x' and 'sigma_y'
+        to arrays of shape (frames, ROIs), with positions in frame pixels.
+    """
+    rois = np.array([[int(v) for v in roi] for roi in rois], dtype=int).reshape(-1, 4)
+    x0s, y0s = np.maximum(rois[:, 0], 0), np.maximum(rois[:, 1], 0)
+    x1s, y1s = rois[:, 0] + rois[:, 2], rois[:, 1] + rois[:, 3]
+    bx0, by0, bx1, by1 = x0s.min(), y0s.min(), x1s.max(), y1s.max()
+    names = ('sum', 'mean', 'max', 'centroid_x', 'centroid_y', 'sigma_x', 'sigma_y')
+    results = {name: [] for name in names}
+
+    for batch in _batches(frames, batch_size):
+        block = np.stack([np.asarray(frame[..., by0:by1, bx0:bx1], dtype=np.float64) for frame in batch])
+        # ROIs relative to the bounding box, clipped to the frame
+        h, w = block.shape[1:]
+        xa, xb = np.clip(x0s - bx0, 0, w), np.clip(x1s - bx0, 0, w)
+        ya, yb = np.clip(y0s - by0, 0, h), np.clip(y1s - by0, 0, h)
+
+        x = np.arange(w, dtype=np.float64)
+        y = np.arange(h, dtype=np.float64)
+        # Integral images along each axis, with a leading zero row / column
+        rows = np.zeros((len(block), h + 1, w))
+        rows[:, 1:] = block.cumsum(axis=1)
+        cols = np.zeros((len(block), h, w + 1))
+        cols[:, :, 1:] = block.cumsum(axis=2)
+        # x projection (frame, ROI, column) and y projection (frame, ROI, row) of every ROI
+        proj_x = (rows[:, yb] - rows[:, ya]) * ((x >= xa[:, None]) & (x < xb[:, None]))
+        proj_y = (cols[:, :, xb] - cols[:, :, xa]).transpose(0, 2, 1) * ((y >= ya[:, None]) & (y < yb[:, None]))
+
+        total = proj_x.sum(axis=2)
+        area = (xb - xa) * (yb - ya)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            cx, cy = proj_x @ x / total, proj_y @ y / total
+            results['sum'].append(total)
+            results['mean'].append(total / area)
+            results['centroid_x'].append(cx + bx0)
+            results['centroid_y'].append(cy + by0)
+            results['sigma_x'].append(np.sqrt(np.maximum(proj_x @ x ** 2 / total - cx ** 2, 0)))
+            results['sigma_y'].append(np.sqrt(np.maximum(proj_y @ y ** 2 / total - cy ** 2, 0)))
+        results['max'].append(np.stack(
+            [block[:, a:b, c:d].max(axis=(1, 2)) if b > a and d > c else np.full(len(block), np.nan)
+             for a, b, c, d in zip(ya, yb, xa, xb)], axis=1))
+
+    return {name: np.concatenate(values) if values else np.empty((0, len(rois)))
+            for name, values in results.items()}
+
+def run_roi_stats(header, num_rois=4, rois=None, batch_size=64):
+    """ Recomputes ROI statistics for every frame of a stored scan.
+
+    Parameters:
+    ----------
+    header : Header
+        The scan header containing the image data and ROI configuration.
+    num_rois : int, optional
+        Number of ROIs to read from the descriptor configuration (default is 4).
+    rois : list, optional
+        List of (x, y, width, height) tuples to use instead of the recorded ROIs.
+    batch_size : int, optional
+        Number of frames processed together (default is 64).
+    Returns:
+    -------
+    dict
+        See compute_roi_stats.
+    """
+    cam_name = header.start['detectors'][0]
+    if rois is None:
+        rois = get_ROI_geometry(num_rois, header)
+    return compute_roi_stats(header.data(f'{cam_name}_image'), rois, batch_size=batch_size)
+
+def run_frame_timing(headers, expected_period=None, tolerance=0.5, root_map=None):
+    """ Checks the camera timing of one or more scans from the detector timestamps alone.
+
+    The AD_HDF5_DET_TS timestamps are read with one read per file; no image data is loaded.
+
+    Parameters:
+    ----------
+    headers : Header or list of Header
+        The scans to check.
+    expected_period : float, optional
+        Nominal frame period in seconds (default is the median interval of each scan).
+    tolerance : float, optional
+        Intervals longer than (1 + tolerance) periods count as dropped frames (default is 0.5).
+    root_map : dict, optional
+        Mapping from resource roots to local paths.
+    Returns:
+    -------
+    dict
+        Scan uid -> {timestamp data key: result of hdf5_reader.frame_timing}.
+    """
+    if not isinstance(headers, (list, tuple)):
+        headers = [headers]
+    results = {}
+    for header in headers:
+        timestamps = read_detector_timestamps(header.documents(fill=False), root_map=root_map)
+        results[header.start['uid']] = {
+            key: frame_timing(ts, fpp, expected_period=expected_period, tolerance=tolerance)
+            for key, (ts, fpp) in timestamps.items()}
+    return results
 
 # EPUs (copied from csx1/startup/accelerator.py)
 epu1 = EPU('XF:23ID-ID{EPU:1', epu_prefix='SR:C23-ID:G1A{EPU:1', ai_prefix='SR:C31-{AI}23', name='epu1')